@@ -4,7 +4,7 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 import time
 import json
 import logging
-from flask import Flask, request, redirect, session, jsonify, send_from_directory
+from flask import Flask, request, redirect, session, jsonify, send_from_directory, Response, stream_with_context
 from flask_session import Session
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -16,6 +16,7 @@ from msal import SerializableTokenCache
 from msal_auth import load_token_cache, save_token_cache, build_msal_app
 from graph_api import (
     search_all_files,
+    iter_search_stages,
     check_file_access,
     send_notification_email,
     send_multiple_file_email,
@@ -29,7 +30,7 @@ from db import (
     delete_old_messages,
     delete_old_chats,
 )
-from hr_router import handle_query,build_hr_knowledge_json
+from hr_router import handle_query,schedule_hr_knowledge_update
 
 
 # 🌱 Load env and init logging
@@ -214,9 +215,9 @@ def upload_hr_doc():
     except Exception as e:
         logging.warning(f"⚠️ Failed to write metadata: {e}")
 
-    # ✅ THIS IS THE FIX: update JSON knowledge base after file upload
-    build_hr_knowledge_json()
-    return jsonify({"message": "✅ File uploaded."})
+    # Re-extract just this document in the background; the upload returns right away
+    schedule_hr_knowledge_update()
+    return jsonify({"message": "✅ File uploaded. The knowledge base is updating."})
 
 
 @app.route("/api/skip_selection", methods=["POST"])
@@ -277,16 +278,9 @@ def chat():
     user_email = session.get("user_email")
 
     # Auth/token handling
-    cache = load_token_cache(account_id)
-    app_msal = build_msal_app(cache)
-    token = None
-    accounts = app_msal.get_accounts()
-    if accounts:
-        result = app_msal.acquire_token_silent(os.getenv("SCOPE").split(), account=accounts[0])
-        if "access_token" in result:
-            token = result["access_token"]
-            session["token"] = token
-            save_token_cache(account_id, cache)
+    token = acquire_graph_token(account_id)
+    if token:
+        session["token"] = token
 
     if not token:
         session.clear()
@@ -342,46 +336,14 @@ def chat():
                 save_message(user_email, chat_id, ai_response=msg)
                 return jsonify(response=msg, intent="file_search")
 
-            perform_access_check = os.getenv("PERFORM_ACCESS_CHECK", "true").lower() == "true"
-            accessible = [
-                f for f in top_files
-                if not perform_access_check or check_file_access(
-                    token, f["id"], user_email, f.get("parentReference", {}).get("siteId")
-                )
-            ]
+            accessible = filter_accessible_files(top_files, token, user_email)
 
             if not accessible:
                 msg = "❌ You don’t have access to the matching files."
                 save_message(user_email, chat_id, ai_response=msg)
                 return jsonify(response=msg, intent="file_search")
 
-            session["stage"] = "awaiting_selection"
-            session["found_files"] = accessible
-
-            per_page = 5
-            page = 1
-            paginated = accessible[:per_page]
-
-            msg = "Please select file (e.g., 1,3):"
-            save_message(user_email, chat_id, ai_response=msg)
-            file_types = list(set([
-                os.path.splitext(f["name"])[1].lower()
-                for f in accessible
-                if "." in f["name"]
-            ]))
-
-            selected_file_ids = [f["id"] for f in accessible]  # You can use this if users selected anything
-            print(f"Total files found: {len(accessible)}")
-            return jsonify({
-                "response": msg,
-                "pauseGPT": True,
-                "files": paginated,
-                "page": page,
-                "total": len(accessible),
-                "file_types": sorted(file_types),
-                "selectedFileIds": selected_file_ids,  # ✅ Add this line
-                "allFileIds": [f["id"] for f in accessible]
-            })
+            return jsonify(present_file_results(accessible, user_email, chat_id))
 
         
         # ✅ General questions fallback to ChatGPT-style response
@@ -402,6 +364,120 @@ def chat():
     return jsonify(response=msg, intent="error")
 
 
+def acquire_graph_token(account_id):
+    cache = load_token_cache(account_id)
+    app_msal = build_msal_app(cache)
+    accounts = app_msal.get_accounts()
+    if accounts:
+        result = app_msal.acquire_token_silent(os.getenv("SCOPE").split(), account=accounts[0])
+        if "access_token" in result:
+            save_token_cache(account_id, cache)
+            return result["access_token"]
+    return None
+
+
+def filter_accessible_files(files, token, user_email):
+    perform_access_check = os.getenv("PERFORM_ACCESS_CHECK", "true").lower() == "true"
+    return [
+        f for f in files
+        if not perform_access_check or check_file_access(
+            token, f["id"], user_email, f.get("parentReference", {}).get("siteId")
+        )
+    ]
+
+
+def present_file_results(accessible, user_email, chat_id):
+    """Store ``accessible`` for selection and build the first-page response payload."""
+    session["stage"] = "awaiting_selection"
+    session["found_files"] = accessible
+
+    per_page = 5
+    page = 1
+    paginated = accessible[:per_page]
+
+    msg = "Please select file (e.g., 1,3):"
+    save_message(user_email, chat_id, ai_response=msg)
+    file_types = list(set([
+        os.path.splitext(f["name"])[1].lower()
+        for f in accessible
+        if "." in f["name"]
+    ]))
+
+    selected_file_ids = [f["id"] for f in accessible]  # You can use this if users selected anything
+    print(f"Total files found: {len(accessible)}")
+    return {
+        "response": msg,
+        "pauseGPT": True,
+        "files": paginated,
+        "page": page,
+        "total": len(accessible),
+        "file_types": sorted(file_types),
+        "selectedFileIds": selected_file_ids,  # ✅ Add this line
+        "allFileIds": [f["id"] for f in accessible]
+    }
+
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+@app.route("/api/search_stream")
+def search_stream():
+    """Stream a file search as server-sent events.
+
+    ``matches`` arrives as soon as the drive fan-out returns (access-checked name hits), ``ranked``
+    carries the same payload /chat returns for a file search, then ``done``.
+    """
+    user_email = session.get("user_email")
+    if not user_email:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    query = request.args.get("q", "").strip()
+    if len(query) < 2:
+        return jsonify({"error": "Query too short"}), 400
+    original_query = request.args.get("original_query") or query
+    chat_id = request.args.get("chat_id") or session.get("chat_id")
+
+    token = acquire_graph_token(session.get("account_id") or "temp")
+    if not token:
+        session.clear()
+        return jsonify(response="❌ Session expired. Please log in again.", intent="session_expired")
+    session["token"] = token
+    session["last_query"] = query
+    save_message(user_email, chat_id, user_message=original_query)
+
+    @stream_with_context
+    def generate():
+        for stage, files in iter_search_stages(token, query, original_query=original_query):
+            if stage == "matches":
+                # Raw hits have not been access-checked yet; only preview the ones that pass
+                preview = filter_accessible_files(files[:20], token, user_email)
+                yield sse_event("matches", {
+                    "files": [{"id": f["id"], "name": f.get("name"), "webUrl": f.get("webUrl")} for f in preview],
+                    "total": len(files),
+                })
+                continue
+
+            accessible = filter_accessible_files(files, token, user_email)
+            if accessible:
+                payload = present_file_results(accessible, user_email, chat_id)
+            else:
+                msg = "❌ You don’t have access to the matching files." if files else "📁 No files found."
+                save_message(user_email, chat_id, ai_response=msg)
+                payload = {"response": msg, "intent": "file_search"}
+            # The body of a streamed response runs after Flask has already saved the
+            # session, so persist the selection state explicitly.
+            app.session_interface.save_session(app, session, app.response_class())
+            yield sse_event("ranked", payload)
+        yield sse_event("done", {})
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/api/paginate_files")
 def paginate_files():
     if not session.get("user_email"):
@@ -550,11 +626,10 @@ def delete_hr_doc():
             with open(metadata_path, "w") as f:
                 json.dump(metadata, f, indent=2)
 
-        # ✅ Rebuild knowledge JSON to reflect current files
-        from hr_router import build_hr_knowledge_json
-        build_hr_knowledge_json()
+        # Drop the document from the knowledge JSON in the background
+        schedule_hr_knowledge_update()
 
-        return jsonify({"message": f"✅ '{filename}' deleted and knowledge base updated."})
+        return jsonify({"message": f"✅ '{filename}' deleted. The knowledge base is updating."})
     except Exception as e:
         logging.exception("❌ Failed to delete document:")
         return jsonify({"error": f"❌ Deletion failed: {e}"}), 500
@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dotenv import load_dotenv
+from lexical_index import CHARS_PER_TOKEN, estimate_tokens
+
+load_dotenv()
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")  # "openai" or "local"
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", os.path.join("cache", "embeddings.db"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 256))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", 100000))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", 4))
+MAX_INPUT_TOKENS = 8191  # per-input limit of the OpenAI embedding models
+
+
+class OpenAIBackend:
+    def __init__(self, model=EMBEDDING_MODEL):
+        from openai import OpenAI
+        self.name = f"openai:{model}"
+        self.model = model
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    def embed(self, texts):
+        response = self.client.embeddings.create(input=texts, model=self.model)
+        return np.array([item.embedding for item in response.data], dtype="float32")
+
+
+class LocalBackend:
+    """sentence-transformers on CPU; lets indexes be built and queried offline.
+
+    Shares the model local_ranker already loads (LOCAL_RANKER_MODEL) rather than keeping a second copy.
+    """
+
+    def __init__(self):
+        import local_ranker  # deferred: local_ranker imports semantic_search, which imports this module
+        self.name = f"local:{local_ranker.LOCAL_RANKER_MODEL}"
+        self.encode = local_ranker.encode
+
+    def embed(self, texts):
+        return self.encode(texts)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_db_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = LocalBackend() if EMBEDDING_BACKEND == "local" else OpenAIBackend()
+    return _backend
+
+
+def connect():
+    os.makedirs(os.path.dirname(EMBEDDING_CACHE_DB) or ".", exist_ok=True)
+    conn = sqlite3.connect(EMBEDDING_CACHE_DB, timeout=30)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            PRIMARY KEY (model, content_hash)
+        )
+    ''')
+    return conn
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_cached(model, hashes):
+    """``{hash: float32 vector}`` for the hashes already embedded with ``model``."""
+    found = {}
+    hashes = list(hashes)
+    conn = connect()
+    c = conn.cursor()
+    for start in range(0, len(hashes), 500):
+        chunk = hashes[start:start + 500]
+        placeholders = ",".join("?" for _ in chunk)
+        c.execute(
+            f'SELECT content_hash, vector FROM embeddings WHERE model = ? AND content_hash IN ({placeholders})',
+            [model] + chunk
+        )
+        for digest, blob in c.fetchall():
+            found[digest] = np.frombuffer(blob, dtype="float16").astype("float32")
+    conn.close()
+    return found
+
+
+def put_cached(model, vectors):
+    """Store ``{hash: vector}`` as float16."""
+    rows = [(model, digest, len(vec), np.asarray(vec, dtype="float16").tobytes()) for digest, vec in vectors.items()]
+    with _db_lock:
+        conn = connect()
+        conn.executemany(
+            'INSERT OR REPLACE INTO embeddings (model, content_hash, dim, vector) VALUES (?, ?, ?, ?)', rows
+        )
+        conn.commit()
+        conn.close()
+
+
+def make_batches(texts, max_items=EMBED_BATCH_SIZE, max_tokens=EMBED_BATCH_TOKENS):
+    """Split ``texts`` into lists that stay under both the item and the estimated token limit."""
+    batch, tokens = [], 0
+    for text in texts:
+        cost = estimate_tokens(text)
+        if batch and (len(batch) >= max_items or tokens + cost > max_tokens):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(text)
+        tokens += cost
+    if batch:
+        yield batch
+
+
+def embed_texts(texts, backend=None):
+    """Embed ``texts`` as a float32 matrix (one row per text).
+
+    Vectors come from the persistent cache (keyed by model and content hash) when
+    present; the rest are deduplicated, split into batches and embedded concurrently.
+    """
+    backend = backend or get_backend()
+    texts = [(t or " ")[:MAX_INPUT_TOKENS * CHARS_PER_TOKEN] for t in texts]
+    hashes = [content_hash(t) for t in texts]
+    vectors = get_cached(backend.name, set(hashes))
+
+    missing = {}
+    for digest, text in zip(hashes, texts):
+        if digest not in vectors:
+            missing[digest] = text
+    if missing:
+        batches = list(make_batches(list(missing.values())))
+        with ThreadPoolExecutor(max_workers=max(1, min(EMBED_WORKERS, len(batches)))) as executor:
+            results = list(executor.map(backend.embed, batches))
+        # Round through float16 so a fresh vector equals what later cache hits return
+        fresh = dict(zip(missing, (vec.astype("float16").astype("float32") for matrix in results for vec in matrix)))
+        put_cached(backend.name, fresh)
+        vectors.update(fresh)
+        logging.info(f"🧮 Embedded {len(missing)} texts in {len(batches)} batches ({len(texts) - len(missing)} cached)")
+
+    return np.array([vectors[digest] for digest in hashes], dtype="float32")
@@ -1,60 +1,273 @@
+import os
+import time
+import hashlib
+import tempfile
+from io import BytesIO
+from contextlib import contextmanager
+import docx
 import pytesseract
 import numpy as np
 import fitz  # PyMuPDF
-from PIL import Image
-from io import BytesIO
-import requests
+import http_client
+from ocr_cache import get_cached_text, put_cached_text, content_key
+from ocr_pool import ocr_images_partial, OCR_WORKERS, OCR_TASK_TIMEOUT
 
 print(pytesseract.get_tesseract_version())
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SPOOL_THRESHOLD = int(os.getenv("EXTRACT_SPOOL_THRESHOLD", 8 * 1024 * 1024))
+MAX_DOWNLOAD_BYTES = int(os.getenv("EXTRACT_MAX_BYTES", 100 * 1024 * 1024))
+SCANNED_PDF_BUDGET = float(os.getenv("SCANNED_PDF_OCR_BUDGET", OCR_TASK_TIMEOUT * 2))
+SCANNED_PAGE_MIN_CHARS = int(os.getenv("SCANNED_PAGE_MIN_CHARS", 25))  # less text than this + an image = scanned
+
+EXTRACTORS = {}  # extension -> fn(source, ocr) where source is a path or bytes
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+# Stream a download into memory, spilling to a temp file past SPOOL_THRESHOLD
+@contextmanager
+def spooled_download(url):
+    """Yield ``(response, source, digest)``.
+
+    ``source`` is the body as bytes when small, a temp file path when large, or None on
+    a non-200 response; ``digest`` is its SHA-256 (the OCR cache content key). Bodies
+    over MAX_DOWNLOAD_BYTES raise DownloadTooLarge. The temp file is removed on exit.
+    """
+    tmp = None
+    try:
+        with http_client.get(url, stream=True) as response:
+            if response.status_code != 200:
+                yield response, None, None
+                return
+            if int(response.headers.get("Content-Length") or 0) > MAX_DOWNLOAD_BYTES:
+                raise DownloadTooLarge(f"{url} exceeds {MAX_DOWNLOAD_BYTES} bytes")
+
+            hasher = hashlib.sha256()
+            buffer = bytearray()
+            total = 0
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                total += len(chunk)
+                if total > MAX_DOWNLOAD_BYTES:
+                    raise DownloadTooLarge(f"{url} exceeds {MAX_DOWNLOAD_BYTES} bytes")
+                hasher.update(chunk)
+                if tmp is not None:
+                    tmp.write(chunk)
+                else:
+                    buffer += chunk
+                    if len(buffer) > SPOOL_THRESHOLD:
+                        tmp = tempfile.NamedTemporaryFile(suffix=".spool", delete=False)
+                        tmp.write(buffer)
+                        buffer = None
+
+            if tmp is not None:
+                tmp.close()
+                yield response, tmp.name, hasher.hexdigest()
+            else:
+                yield response, bytes(buffer), hasher.hexdigest()
+    finally:
+        if tmp is not None:
+            tmp.close()
+            try:
+                os.remove(tmp.name)
+            except OSError:
+                pass
+
+
+def open_pdf(source):
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+# Page-by-page generator so callers never hold a whole document's images at once
+def iter_page_images(pdf_file):
+    for page in pdf_file:
+        yield page.get_pixmap().tobytes("png")
+
+
+# OCR an image (bytes or spooled path), consulting/filling the OCR cache;
+# partial (timed-out) text is not cached
+def ocr_image_cached(source, data_key, cache_key=None, budget=OCR_TASK_TIMEOUT):
+    text = get_cached_text(data_key)
+    if text is None:
+        texts, complete = ocr_images_partial([source], budget=budget)
+        text = texts[0]
+        if not complete:
+            return text
+        put_cached_text(data_key, text)
+    put_cached_text(cache_key, text)
+    return text
+
+
+def ocr_image_bytes_cached(data, cache_key=None):
+    return ocr_image_cached(data, content_key(data), cache_key)
+
+
 # OCR for images using Tesseract
-def extract_text_from_image(image_url):
+def extract_text_from_image(image_url, cache_key=None):
+    """OCR an image URL. ``cache_key`` (see ocr_cache.item_key) skips the download on a hit;
+    otherwise the downloaded bytes' hash is checked before running Tesseract."""
+    cached = get_cached_text(cache_key)
+    if cached is not None:
+        return cached
     try:
-        response = requests.get(image_url)
-        img = Image.open(BytesIO(response.content)).convert("L")  # grayscale
-        img = img.resize((img.width * 2, img.height * 2))  # upscale for better OCR
-        text = pytesseract.image_to_string(img)
-        return text.strip()
+        with spooled_download(image_url) as (response, source, data_key):
+            if source is None:
+                print(f"⚠️ Invalid image response: {image_url}")
+                return ""
+            return ocr_image_cached(source, data_key, cache_key)
     except Exception as e:
         print(f"❌ Tesseract OCR failed: {e}")
         return ""
 
+
 # Extract text from scanned PDFs using Tesseract OCR
-def extract_text_from_scanned_pdf(pdf_url):
+def extract_text_from_scanned_pdf(pdf_url, cache_key=None):
+    cached = get_cached_text(cache_key)
+    if cached is not None:
+        return cached
     try:
-        response = requests.get(pdf_url)
-        if response.status_code != 200 or "pdf" not in response.headers.get("Content-Type", "").lower():
-            print(f"⚠️ Invalid scanned PDF response: {pdf_url}")
-            return ""
-
-        pdf_file = fitz.open(stream=response.content, filetype="pdf")
-        text = ""
-        for page_num in range(pdf_file.page_count):
-            page = pdf_file.load_page(page_num)
-            pix = page.get_pixmap()
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples).convert("L")
-            img = img.resize((img.width * 2, img.height * 2))
-            text += pytesseract.image_to_string(img) + "\n"
-        return text.strip()
+        with spooled_download(pdf_url) as (response, source, data_key):
+            if source is None or "pdf" not in response.headers.get("Content-Type", "").lower():
+                print(f"⚠️ Invalid scanned PDF response: {pdf_url}")
+                return ""
+
+            cached = get_cached_text(data_key)
+            if cached is not None:
+                put_cached_text(cache_key, cached)
+                return cached
+
+            # Render a window of pages at a time and OCR it in parallel on the process pool,
+            # all under one deadline for the whole document.
+            deadline = time.monotonic() + SCANNED_PDF_BUDGET
+            texts, complete, window = [], True, []
+            with open_pdf(source) as pdf_file:
+                for image in iter_page_images(pdf_file):
+                    window.append(image)
+                    if len(window) >= OCR_WORKERS * 2:
+                        complete &= ocr_window(window, deadline, texts)
+                        window = []
+                if window:
+                    complete &= ocr_window(window, deadline, texts)
+
+            text = "\n".join(texts).strip()
+            if complete:
+                put_cached_text(data_key, text)
+                put_cached_text(cache_key, text)
+            return text
     except Exception as e:
         print(f"❌ Tesseract PDF OCR failed: {e}")
         return ""
 
-# Text extraction from PDFs (non-scanned)
+
+def ocr_window(images, deadline, texts):
+    """OCR ``images`` into ``texts`` before ``deadline`` (None: no deadline). Returns completeness."""
+    remaining = None if deadline is None else deadline - time.monotonic()
+    if remaining is not None and remaining <= 0:
+        return False
+    window_texts, complete = ocr_images_partial(images, budget=remaining)
+    texts.extend(window_texts)
+    return complete
+
+
+# Text extraction from PDFs; pages without a text layer are OCR'd
 def extract_text_from_pdf(pdf_url):
     try:
-        response = requests.get(pdf_url)
-        content_type = response.headers.get("Content-Type", "")
-        if response.status_code != 200 or "pdf" not in content_type.lower():
-            print(f"⚠️ Invalid PDF response from {pdf_url} — Content-Type: {content_type}")
-            return ""
-
-        pdf_file = fitz.open(stream=response.content, filetype="pdf")
-        text = ""
-        for page_num in range(pdf_file.page_count):
-            page = pdf_file.load_page(page_num)
-            text += page.get_text()
-        return text.strip()
+        with spooled_download(pdf_url) as (response, source, _):
+            content_type = response.headers.get("Content-Type", "")
+            if source is None or "pdf" not in content_type.lower():
+                print(f"⚠️ Invalid PDF response from {pdf_url} — Content-Type: {content_type}")
+                return ""
+            return extract_pdf(source)
     except Exception as e:
         print(f"❌ PyMuPDF failed to open PDF: {e}")
         return ""
+
+
+def register_extractor(*extensions):
+    """Decorator adding ``fn(source, ocr, budget)`` to EXTRACTORS for the given file extensions."""
+    def register(fn):
+        for ext in extensions:
+            EXTRACTORS[ext] = fn
+        return fn
+    return register
+
+
+def is_scanned_page(page, text):
+    return len(text.strip()) < SCANNED_PAGE_MIN_CHARS and bool(page.get_images())
+
+
+def has_scanned_pages(source):
+    """True when ``extract_pdf`` would OCR at least one page of the PDF."""
+    with open_pdf(source) as pdf_file:
+        return any(is_scanned_page(page, page.get_text()) for page in pdf_file)
+
+
+@register_extractor(".pdf")
+def extract_pdf(source, ocr=True, budget=SCANNED_PDF_BUDGET):
+    """PyMuPDF text layer page by page; only pages that look scanned are rendered and OCR'd,
+    in parallel under one ``budget``-second deadline (None: wait for every page)."""
+    deadline = None if budget is None else time.monotonic() + budget
+    texts, window = [], []
+
+    def flush():
+        ocr_texts = []
+        ocr_window([image for _, image in window], deadline, ocr_texts)
+        for (page_no, _), text in zip(window, ocr_texts):
+            texts[page_no] = text
+        window.clear()
+
+    with open_pdf(source) as pdf_file:
+        for page in pdf_file:
+            text = page.get_text()
+            if ocr and is_scanned_page(page, text):
+                window.append((len(texts), page.get_pixmap().tobytes("png")))
+            texts.append(text)
+            if len(window) >= OCR_WORKERS * 2:
+                flush()
+    if window:
+        flush()
+    return "\n".join(t.strip() for t in texts if t.strip())
+
+
+@register_extractor(".docx")
+def extract_docx(source, ocr=True, budget=None):
+    doc = docx.Document(source if isinstance(source, str) else BytesIO(source))
+    return "\n".join(p.text for p in doc.paragraphs).strip()
+
+
+@register_extractor(".txt", ".md", ".csv")
+def extract_plain_text(source, ocr=True, budget=None):
+    if isinstance(source, str):
+        with open(source, "r", encoding="utf-8", errors="replace") as f:
+            return f.read().strip()
+    return source.decode("utf-8", errors="replace").strip()
+
+
+@register_extractor(".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".gif")
+def extract_image(source, ocr=True, budget=OCR_TASK_TIMEOUT):
+    if not ocr:
+        return ""
+    data_key = content_key(source) if isinstance(source, bytes) else None
+    return ocr_image_cached(source, data_key, budget=budget)
+
+
+def extract_text(source, filename=None, ocr=True, budget=SCANNED_PDF_BUDGET):
+    """Text of a document given as a path or bytes, using the extractor for its extension.
+
+    ``filename`` supplies the extension for byte sources (paths use their own). ``budget``
+    caps the seconds spent on OCR; offline builds whose text is kept pass None to wait for
+    every page. Returns None for unsupported formats and "" when extraction fails.
+    """
+    name = filename or (source if isinstance(source, str) else "")
+    extractor = EXTRACTORS.get(os.path.splitext(name)[1].lower())
+    if extractor is None:
+        return None
+    try:
+        return extractor(source, ocr, budget)
+    except Exception as e:
+        print(f"❌ Extraction failed for {name or 'document'}: {e}")
+        return ""
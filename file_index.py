@@ -0,0 +1,288 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from lexical_index import InvertedIndex
+
+FILE_INDEX_DB = os.getenv("FILE_INDEX_DB", os.path.join("cache", "file_index.db"))
+FILE_INDEX_MAX_AGE = int(os.getenv("FILE_INDEX_MAX_AGE", 900))
+DELTA_SELECT = "id,name,parentReference,webUrl,file,folder,size,lastModifiedDateTime,eTag,cTag,deleted"
+
+_syncing = set()
+_sync_lock = threading.Lock()
+_indexes = {}  # scope -> (InvertedIndex, version it was built at)
+_indexes_lock = threading.Lock()
+ITEM_COLUMNS = "item_id, drive_id, site_id, name, path, web_url, mime_type, size, modified, etag, ctag"
+
+
+def connect():
+    os.makedirs(os.path.dirname(FILE_INDEX_DB) or ".", exist_ok=True)
+    conn = sqlite3.connect(FILE_INDEX_DB, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def init_file_index():
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS items (
+            scope TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            drive_id TEXT NOT NULL,
+            site_id TEXT,
+            name TEXT NOT NULL,
+            path TEXT,
+            web_url TEXT,
+            mime_type TEXT,
+            size INTEGER,
+            modified TEXT,
+            etag TEXT,
+            ctag TEXT,
+            extracted_text TEXT,
+            PRIMARY KEY (scope, item_id)
+        )
+    ''')
+    c.execute('PRAGMA table_info(items)')
+    if "extracted_text" not in [col[1] for col in c.fetchall()]:
+        c.execute('ALTER TABLE items ADD COLUMN extracted_text TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_items_drive ON items (scope, drive_id)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS drive_state (
+            scope TEXT NOT NULL,
+            drive_id TEXT NOT NULL,
+            site_id TEXT,
+            delta_link TEXT,
+            synced_at REAL,
+            PRIMARY KEY (scope, drive_id)
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def item_row(scope, item, drive_id, site_id):
+    parent = item.get("parentReference", {})
+    return (
+        scope,
+        item["id"],
+        drive_id,
+        site_id or parent.get("siteId"),
+        item["name"],
+        parent.get("path"),
+        item.get("webUrl"),
+        item.get("file", {}).get("mimeType"),
+        item.get("size"),
+        item.get("lastModifiedDateTime"),
+        item.get("eTag"),
+        item.get("cTag"),
+    )
+
+
+def row_to_item(row):
+    """Rebuild a Graph-shaped driveItem from an index row."""
+    item_id, drive_id, site_id, name, path, web_url, mime_type, size, modified, etag, ctag = row
+    return {
+        "id": item_id,
+        "name": name,
+        "webUrl": web_url,
+        "size": size,
+        "lastModifiedDateTime": modified,
+        "eTag": etag,
+        "cTag": ctag,
+        "file": {"mimeType": mime_type},
+        "parentReference": {"driveId": drive_id, "siteId": site_id, "path": path},
+    }
+
+
+def sync_drive(scope, drive_id, site_id, fetch_json):
+    """Apply one delta round for a drive. ``fetch_json(url)`` returns a parsed page or None.
+
+    Starts from the stored delta link when there is one, so only changes since the last
+    sync are transferred. Returns the set of item ids that changed or were removed.
+    """
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT delta_link FROM drive_state WHERE scope = ? AND drive_id = ?', (scope, drive_id))
+    row = c.fetchone()
+    url = row[0] if row and row[0] else f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root/delta?$select={DELTA_SELECT}"
+
+    changed = set()
+    delta_link = None
+    try:
+        if not (row and row[0]):
+            # Full walk: replace the drive's rows in the same transaction.
+            c.execute('SELECT item_id FROM items WHERE scope = ? AND drive_id = ?', (scope, drive_id))
+            changed.update(r[0] for r in c.fetchall())
+            c.execute('DELETE FROM items WHERE scope = ? AND drive_id = ?', (scope, drive_id))
+        while url:
+            page = fetch_json(url)
+            if page is None:
+                # Expired link or unreadable drive (403/404/410): start over with a full walk
+                # next time, but record the attempt so the drive does not keep the index stale.
+                conn.rollback()
+                c.execute(
+                    'INSERT OR REPLACE INTO drive_state (scope, drive_id, site_id, delta_link, synced_at) VALUES (?, ?, ?, NULL, ?)',
+                    (scope, drive_id, site_id, time.time())
+                )
+                conn.commit()
+                return None
+            upserts, removals = [], []
+            for item in page.get("value", []):
+                changed.add(item["id"])
+                if "deleted" in item or "@removed" in item or "folder" in item:
+                    removals.append((scope, item["id"]))
+                elif item.get("name") and "file" in item:
+                    upserts.append(item_row(scope, item, drive_id, site_id))
+            c.executemany('DELETE FROM items WHERE scope = ? AND item_id = ?', removals)
+            c.executemany(
+                f'INSERT OR REPLACE INTO items (scope, {ITEM_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                upserts
+            )
+            delta_link = page.get("@odata.deltaLink")
+            url = page.get("@odata.nextLink")
+
+        c.execute(
+            'INSERT OR REPLACE INTO drive_state (scope, drive_id, site_id, delta_link, synced_at) VALUES (?, ?, ?, ?, ?)',
+            (scope, drive_id, site_id, delta_link, time.time())
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    refresh_scope_index(scope, changed)
+    return changed
+
+
+def is_fresh(scope, drive_ids=None, max_age=FILE_INDEX_MAX_AGE):
+    """True when every synced drive, plus any drive in ``drive_ids``, synced within ``max_age``."""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT drive_id, synced_at FROM drive_state WHERE scope = ?', (scope,))
+    synced = dict(c.fetchall())
+    conn.close()
+    if not synced:
+        return False
+    wanted = set(synced) | set(drive_ids or [])
+    cutoff = time.time() - max_age
+    return all((synced.get(d) or 0) >= cutoff for d in wanted)
+
+
+def index_version(c, scope):
+    c.execute('SELECT MAX(synced_at) FROM drive_state WHERE scope = ?', (scope,))
+    return c.fetchone()[0] or 0
+
+
+def add_rows_to_index(index, rows):
+    for item_id, name, path, extracted_text in rows:
+        index.add(item_id, {"name": name, "path": path, "extracted_text": extracted_text})
+
+
+def scope_index(scope):
+    """In-memory BM25 index for ``scope``, rebuilt when another process has synced since."""
+    conn = connect()
+    c = conn.cursor()
+    version = index_version(c, scope)
+    with _indexes_lock:
+        cached = _indexes.get(scope)
+        if cached and cached[1] >= version:
+            conn.close()
+            return cached[0]
+        index = InvertedIndex()
+        c.execute('SELECT item_id, name, path, extracted_text FROM items WHERE scope = ?', (scope,))
+        add_rows_to_index(index, c.fetchall())
+        _indexes[scope] = (index, version)
+    conn.close()
+    return index
+
+
+def refresh_scope_index(scope, item_ids):
+    """Apply changed/removed ``item_ids`` to an already-loaded scope index."""
+    with _indexes_lock:
+        cached = _indexes.get(scope)
+    if not cached or not item_ids:
+        return
+    index = cached[0]
+    conn = connect()
+    c = conn.cursor()
+    ids = list(item_ids)
+    found = set()
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ",".join("?" for _ in chunk)
+        c.execute(
+            f'SELECT item_id, name, path, extracted_text FROM items WHERE scope = ? AND item_id IN ({placeholders})',
+            [scope] + chunk
+        )
+        rows = c.fetchall()
+        found.update(r[0] for r in rows)
+        add_rows_to_index(index, rows)
+    for item_id in set(ids) - found:
+        index.remove(item_id)
+    version = index_version(c, scope)
+    conn.close()
+    with _indexes_lock:
+        if _indexes.get(scope, (None,))[0] is index:
+            _indexes[scope] = (index, version)
+
+
+def item_names(scope, item_ids):
+    """Names of the indexed items among ``item_ids`` (removed items are simply absent)."""
+    ids = list(item_ids)
+    names = []
+    conn = connect()
+    c = conn.cursor()
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ",".join("?" for _ in chunk)
+        c.execute(f'SELECT name FROM items WHERE scope = ? AND item_id IN ({placeholders})', [scope] + chunk)
+        names.extend(r[0] for r in c.fetchall())
+    conn.close()
+    return names
+
+
+def search_file_index(scope, query, limit=200):
+    """Best BM25 matches for ``query`` over names, paths and extracted text."""
+    hits = scope_index(scope).top_k(query, limit)
+    if not hits:
+        return []
+    ids = [item_id for item_id, _ in hits]
+    placeholders = ",".join("?" for _ in ids)
+    conn = connect()
+    c = conn.cursor()
+    c.execute(f'SELECT {ITEM_COLUMNS} FROM items WHERE scope = ? AND item_id IN ({placeholders})', [scope] + ids)
+    rows = {r[0]: r for r in c.fetchall()}
+    conn.close()
+    return [row_to_item(rows[item_id]) for item_id in ids if item_id in rows]
+
+
+def store_extracted_text(scope, item_id, text):
+    """Persist OCR/extracted text for an indexed item so later queries can match on it."""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('UPDATE items SET extracted_text = ? WHERE scope = ? AND item_id = ?', (text, scope, item_id))
+    conn.commit()
+    conn.close()
+    refresh_scope_index(scope, [item_id])
+
+
+def sync_in_background(scope, sync):
+    """Run ``sync()`` on a daemon thread unless one is already running for ``scope``."""
+    with _sync_lock:
+        if scope in _syncing:
+            return
+        _syncing.add(scope)
+
+    def run():
+        try:
+            sync()
+        except Exception as e:
+            logging.error(f"❌ File index sync failed for {scope}: {e}")
+        finally:
+            with _sync_lock:
+                _syncing.discard(scope)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+init_file_index()
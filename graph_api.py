@@ -1,15 +1,34 @@
-import requests
+import http_client
 import os
 import time
 import logging
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from perplexity_ranker import rank_files_with_perplexity
-from msal_auth import load_token_cache, save_token_cache, build_msal_app
+from local_ranker import rank_files_locally
+from msal_auth import load_token_cache, save_token_cache, build_msal_app, token_claims
 from extractor import extract_text_from_scanned_pdf, extract_text_from_pdf, extract_text_from_image
+from topology_cache import TopologyCache
+from ocr_cache import item_key
+from rate_limiter import governor, endpoint_class, parse_retry_after
+from file_index import sync_drive, is_fresh, search_file_index, sync_in_background, store_extracted_text, item_names
+from query_cache import query_cache, query_cache_key
 
 logging.basicConfig(level=logging.INFO)
 
+SEARCH_WORKERS = int(os.getenv("GRAPH_SEARCH_WORKERS", 30))
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+GRAPH_BATCH_SIZE = 20  # hard limit of the JSON batching endpoint
+GRAPH_BATCH_WORKERS = int(os.getenv("GRAPH_BATCH_WORKERS", 4))
+ASYNC_SEARCH = os.getenv("GRAPH_ASYNC_SEARCH", "false").lower() == "true"
+FILE_INDEX_ENABLED = os.getenv("FILE_INDEX_ENABLED", "false").lower() == "true"
+OCR_DOWNLOAD_WORKERS = int(os.getenv("OCR_DOWNLOAD_WORKERS", 8))
+SEARCH_BUDGET_SECONDS = float(os.getenv("SEARCH_BUDGET_SECONDS", 25))
+RANKER = os.getenv("FILE_RANKER", "local")  # "local" or "perplexity"
+
+topology_cache = TopologyCache()
+
 def refresh_token(account_id):
     cache = load_token_cache(account_id)
     app = build_msal_app(cache)
@@ -22,36 +41,119 @@ def refresh_token(account_id):
     return None
 
 def retry_request(url, headers, method="get", json=None, max_retries=2, account_id=None):
+    endpoint = endpoint_class(url)
+    res = None
     for i in range(max_retries + 1):
+        governor.acquire(endpoint)
+        failed = False
         try:
-            res = requests.request(method, url, headers=headers, json=json)
-            if res.status_code == 401 and account_id:
-                logging.warning("Received 401 Unauthorized. Attempting token refresh...")
-                token = refresh_token(account_id)
-                if token:
-                    headers["Authorization"] = f"Bearer {token}"
-                    continue
-            elif res.status_code == 429:
-                retry_after = int(res.headers.get("Retry-After", 5))
-                logging.warning(f"Rate limited on {url}. Retrying after {retry_after} seconds...")
-                time.sleep(retry_after)
-            else:
-                logging.info(f"Request to {url} returned status {res.status_code}")
-                return res
+            res = http_client.request(method, url, headers=headers, json=json)
         except Exception as e:
+            failed = True
             logging.error(f"Request error on {url}: {e}")
+        finally:
+            governor.release()
+        if failed:
+            time.sleep(governor.backoff(i))
+            continue
+
+        if res.status_code == 401 and account_id:
+            logging.warning("Received 401 Unauthorized. Attempting token refresh...")
+            token = refresh_token(account_id)
+            if token:
+                headers["Authorization"] = f"Bearer {token}"
+                continue
+        elif res.status_code in (429, 503):
+            retry_after = parse_retry_after(res.headers.get("Retry-After"))
+            logging.warning(f"Rate limited on {url}. Pausing Graph calls for {retry_after} seconds...")
+            governor.on_throttle(retry_after)
+            time.sleep(governor.backoff(i))
+        else:
+            governor.on_success()
+            logging.info(f"Request to {url} returned status {res.status_code}")
+            return res
     logging.error(f"Max retries exceeded for {url}")
     return res
 
-def get_file_with_download_url(drive_id, item_id, token):
-    headers = {"Authorization": f"Bearer {token}"}
-    url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{item_id}"
-    res = requests.get(url, headers=headers)
-    if res.status_code == 200:
-        return res.json()
-    else:
-        logging.warning(f"⚠️ Failed to fetch full metadata for item {item_id}")
-        return None
+def needs_enrichment(item):
+    """True when a search hit lacks metadata the content stage needs.
+
+    Only images use ``@microsoft.graph.downloadUrl`` (for OCR); everything else is
+    described by name and webUrl, which search results already carry.
+    """
+    if "folder" in item or item.get("@microsoft.graph.downloadUrl"):
+        return False
+    if not item.get("parentReference", {}).get("driveId"):
+        return False
+    if not item.get("name") or not item.get("webUrl") or "file" not in item:
+        return True
+    return "image" in item["file"].get("mimeType", "")
+
+def merge_item_metadata(item, metadata):
+    # The hit's own parentReference carries the siteId/driveId we tagged it with; keep those
+    parent = {**metadata.get("parentReference", {}), **item.get("parentReference", {})}
+    item.update(metadata)
+    item["parentReference"] = parent
+    return item
+
+def build_metadata_batch(items):
+    return {
+        "requests": [
+            {
+                "id": str(i),
+                "method": "GET",
+                "url": f"/drives/{item['parentReference']['driveId']}/items/{item['id']}",
+            }
+            for i, item in enumerate(items)
+        ]
+    }
+
+def apply_metadata_batch(items, responses):
+    """Merge $batch replies into ``items``. Returns (throttled_items, retry_after_seconds)."""
+    throttled, retry_after = [], 0
+    for reply in responses:
+        item = items[int(reply["id"])]
+        status = reply.get("status")
+        if status == 200:
+            merge_item_metadata(item, reply.get("body", {}))
+        elif status == 429:
+            throttled.append(item)
+            retry_after = max(retry_after, parse_retry_after(reply.get("headers", {}).get("Retry-After")))
+        else:
+            logging.warning(f"⚠️ Failed to fetch full metadata for item {item['id']}")
+    return throttled, retry_after
+
+def post_metadata_batch(items, headers):
+    """Fetch one $batch of driveItems. Returns (throttled_items, retry_after_seconds)."""
+    res = retry_request(GRAPH_BATCH_URL, headers, method="post", json=build_metadata_batch(items))
+    if res.status_code != 200:
+        logging.warning(f"⚠️ Metadata batch failed with status {res.status_code}")
+        return [], 0
+    return apply_metadata_batch(items, res.json().get("responses", []))
+
+def enrich_files_batch(files, token, max_retries=2):
+    """Enrich search hits in place through Graph JSON $batch, 20 items per request.
+
+    Hits that already carry enough metadata are skipped. Folders and hits without a
+    name are dropped from the returned list.
+    """
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    pending = [f for f in files if needs_enrichment(f)]
+    logging.info(f"Enriching {len(pending)} of {len(files)} files via $batch")
+
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        chunks = [pending[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(pending), GRAPH_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=min(GRAPH_BATCH_WORKERS, len(chunks))) as executor:
+            outcomes = list(executor.map(lambda chunk: post_metadata_batch(chunk, headers), chunks))
+        pending = [item for throttled, _ in outcomes for item in throttled]
+        if pending and attempt < max_retries:
+            retry_after = max(wait_for for _, wait_for in outcomes)
+            logging.warning(f"Batch items throttled. Retrying {len(pending)} after {retry_after} seconds...")
+            governor.on_throttle(retry_after)
+
+    return [f for f in files if f.get("name") and "folder" not in f]
 
 def get_user_email(account_id):
     token = refresh_token(account_id)
@@ -63,117 +165,400 @@ def get_user_email(account_id):
         return res.json().get("mail") or res.json().get("userPrincipalName")
     return None
 
+def fetch_sites_page(url, headers):
+    """Return (sites, next_link); sites is None when the page could not be fetched."""
+    res = retry_request(url, headers)
+    if res is None or res.status_code != 200:
+        return None, None
+    data = res.json()
+    return data.get("value", []), data.get("@odata.nextLink")
+
 def discover_all_sites(token):
+    """Every site visible to the user, or None if a page failed and the list would be truncated."""
     headers = {"Authorization": f"Bearer {token}"}
     sites = []
     url = "https://graph.microsoft.com/v1.0/sites?search=*"
+    while url:
+        page, url = fetch_sites_page(url, headers)
+        if page is None:
+            return None
+        sites.extend(page)
+    return sites
+
+def list_site_drives(site_id, headers):
+    """The site's drives; [] when the user may not list them, None when the call failed."""
+    res = retry_request(f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives", headers)
+    if res is not None and res.status_code in (403, 404):
+        return []
+    if res is None or res.status_code != 200:
+        return None
+    return [{"id": d["id"], "name": d.get("name")} for d in res.json().get("value", [])]
+
+def fetch_sites_delta(token, delta_link=None):
+    """Return (changed_sites, removed_site_ids, delta_link), or None if the delta call fails.
+
+    Without a delta link this asks for ``token=latest`` which only establishes a baseline.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    url = delta_link or "https://graph.microsoft.com/v1.0/sites/delta?token=latest"
+    changed, removed = [], []
     while url:
         res = retry_request(url, headers)
-        if res.status_code == 200:
-            data = res.json()
-            sites.extend(data.get("value", []))
-            url = data.get("@odata.nextLink")
+        if res.status_code != 200:
+            return None
+        data = res.json()
+        for site in data.get("value", []):
+            if "@removed" in site or "deleted" in site:
+                removed.append(site["id"])
+            elif site.get("id"):
+                changed.append(site)
+        if "@odata.deltaLink" in data:
+            return changed, removed, data["@odata.deltaLink"]
+        url = data.get("@odata.nextLink")
+    return None
+
+def load_site_topology(token, previous=None):
+    """Full ``{site_id: drives}`` listing, or None when it would be incomplete.
+
+    A site whose drive listing fails keeps its entry from ``previous``; if it has none, or
+    the site list itself was truncated, the listing is incomplete. /sites/delta only
+    reports changed sites, so anything left out here would stay missing until the next
+    full refresh.
+    """
+    all_sites = discover_all_sites(token)
+    if all_sites is None:
+        return None
+    previous = previous or {}
+    headers = {"Authorization": f"Bearer {token}"}
+    topology = {}
+    for site in all_sites:
+        site_id = site.get("id")
+        if not site_id:
+            continue
+        drives = list_site_drives(site_id, headers)
+        if drives is None:
+            drives = previous.get(site_id)
+            if drives is None:
+                return None
+        topology[site_id] = drives
+    return topology
+
+def user_scope(token):
+    """``(tenant id, user oid)`` from the token; results listed with it are only valid for that user."""
+    claims = token_claims(token)
+    return claims.get("tid", "default"), claims.get("oid", "default")
+
+def topology_scope(token):
+    return ":".join(user_scope(token))
+
+def refresh_site_topology(token, scope):
+    """Refresh the user's cached topology, incrementally via /sites/delta when possible."""
+    delta = None
+    if not topology_cache.needs_full_refresh(scope):
+        delta = fetch_sites_delta(token, topology_cache.delta_link(scope))
+
+    if delta is None:
+        sites = load_site_topology(token, topology_cache.sites(scope))
+        if sites is None:
+            # Keep what is cached; needs_full_refresh stays true, so the next stale lookup retries
+            logging.warning(f"⚠️ Incomplete site listing for {scope}; topology not stored")
+            return
+        baseline = fetch_sites_delta(token)
+        topology_cache.store(scope, sites, baseline[2] if baseline else None)
+        query_cache.invalidate_scope(*user_scope(token))
+        logging.info(f"🗺️ Full topology load for {scope}: {len(sites)} sites")
+        return
+
+    changed, removed, delta_link = delta
+    headers = {"Authorization": f"Bearer {token}"}
+    updated, failed = {}, 0
+    for site in changed:
+        drives = list_site_drives(site["id"], headers)
+        if drives is not None:
+            updated[site["id"]] = drives
         else:
-            break
-    return sites
+            failed += 1
+    if failed:
+        # Keep the old link so the next delta round reports the failed sites again
+        delta_link = topology_cache.delta_link(scope)
+    topology_cache.apply_delta(scope, updated, removed, delta_link)
+    if updated or removed:
+        query_cache.invalidate_scope(*user_scope(token))
+    logging.info(f"🗺️ Delta topology refresh for {scope}: {len(updated)} changed, {len(removed)} removed")
 
-def search_all_files(token, query,original_query=None):
+def search_drive(drive_id, site_id, q, headers):
+    search_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/search(q='{q}')"
+    search_res = retry_request(search_url, headers)
+    if search_res.status_code != 200:
+        return []
+    return tag_site_id(search_res.json().get("value", []), site_id)
+
+def search_sharepoint_drives(token, query_batch, max_workers=None, deadline=None):
+    """Search every SharePoint drive, overlapping site/drive enumeration with the searches.
+
+    With a warm topology cache all drive searches are submitted up front. When cold, site
+    pages, drive listings and drive searches share one bounded executor: each listing feeds
+    its searches into the pool as soon as it lands, and the result seeds the cache.
+    Drives still pending at ``deadline`` (a time.monotonic() value) are abandoned.
+    """
     headers = {"Authorization": f"Bearer {token}"}
-    all_results = []
-    seen_ids = set()
+    scope = topology_scope(token)
+    sites = topology_cache.sites(scope)
+    cold = sites is None
+    if not cold and topology_cache.is_stale(scope):
+        topology_cache.refresh_in_background(scope, lambda: refresh_site_topology(token, scope))
 
-    overall_start = time.time()
-    print("🔍 [1] Starting file search...")
+    results = []
+    topology = {}
+    delta_link = None
+    complete = True  # every site page and drive listing of a cold crawl succeeded
+    executor = ThreadPoolExecutor(max_workers=max_workers or SEARCH_WORKERS)
+    pending = {}
+
+    def submit(kind, fn, *args):
+        pending[executor.submit(fn, *args)] = (kind, args)
+
+    def submit_searches(site_id, drives):
+        for drive in drives:
+            for q in query_batch:
+                submit("search", search_drive, drive["id"], site_id, q, headers)
+
+    try:
+        if cold:
+            submit("sites", fetch_sites_page, "https://graph.microsoft.com/v1.0/sites?search=*", headers)
+            submit("delta", fetch_sites_delta, token)
+        else:
+            for site_id, drives in sites.items():
+                submit_searches(site_id, drives)
+
+        while pending:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                logging.warning(f"⏱️ Search budget spent; abandoning {len(pending)} pending drive calls")
+                break
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, args = pending.pop(future)
+                try:
+                    value = future.result()
+                except Exception as e:
+                    logging.error(f"❌ Drive {kind} error: {e}")
+                    if kind in ("sites", "drives"):
+                        complete = False
+                    continue
+                if kind == "sites":
+                    page, next_url = value
+                    if page is None:
+                        complete = False
+                    if next_url:
+                        submit("sites", fetch_sites_page, next_url, headers)
+                    for site in page or []:
+                        if site.get("id"):
+                            submit("drives", list_site_drives, site["id"], headers)
+                elif kind == "drives":
+                    if value is None:
+                        complete = False
+                    else:
+                        topology[args[0]] = value
+                        submit_searches(args[0], value)
+                elif kind == "delta":
+                    delta_link = value[2] if value else None
+                else:
+                    results.extend(value)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if cold and (pending or not complete):
+        # Partial crawl or failed listings: don't cache an incomplete topology (delta refreshes
+        # would never bring the missing sites back); finish it in the background.
+        topology_cache.refresh_in_background(scope, lambda: refresh_site_topology(token, scope))
+    elif cold:
+        topology_cache.store(scope, topology, delta_link)
+    return results
+
+def fetch_graph_json(url, headers):
+    res = retry_request(url, headers)
+    if res is None or res.status_code != 200:
+        return None
+    return res.json()
+
+def sync_file_index(token):
+    """Bring the local file index up to date with /delta on the personal drive and every site drive."""
+    headers = {"Authorization": f"Bearer {token}"}
+    scope = token_claims(token).get("oid", "default")
+    topology = topology_scope(token)
+    if topology_cache.sites(topology) is None:
+        refresh_site_topology(token, topology)
 
+    drives = [(d["id"], site_id) for site_id, site_drives in (topology_cache.sites(topology) or {}).items() for d in site_drives]
+    me_drive = fetch_graph_json("https://graph.microsoft.com/v1.0/me/drive", headers)
+    if me_drive:
+        drives.append((me_drive["id"], None))
+
+    def sync(drive):
+        changed = sync_drive(scope, drive[0], drive[1], lambda url: fetch_graph_json(url, headers))
+        if changed:
+            query_cache.invalidate_items(changed, item_names(scope, changed))
+        return changed
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+        list(executor.map(sync, drives))
+    logging.info(f"📇 File index synced {len(drives)} drives in {time.time() - start:.2f}s")
+
+def search_indexed_files(token, query_batch):
+    """Answer from the local file index, or None when it is stale (a background sync is started)."""
+    scope = token_claims(token).get("oid", "default")
+    sites = topology_cache.sites(topology_scope(token)) or {}
+    drive_ids = [d["id"] for site_drives in sites.values() for d in site_drives]
+    if not is_fresh(scope, drive_ids):
+        sync_in_background(scope, lambda: sync_file_index(token))
+        return None
+    return [item for q in query_batch for item in search_file_index(scope, q)]
+
+def split_query(query):
+    """``(core, year)``: the lowercased query with its year token removed, and that year (or None)."""
     year_match = re.search(r'\b(19|20)\d{2}\b', query)
     year = year_match.group() if year_match else None
 
     words = query.split()
     if year and year in words:
         words.remove(year)
-        
-    core = " ".join(words).strip().lower()
-    query_batch = [core]
-
-    # Search personal drive
-    for q in query_batch:
-        me_url = f"https://graph.microsoft.com/v1.0/me/drive/root/search(q='{q}')"
-        me_res = retry_request(me_url, headers)
-        if me_res.status_code == 200:
-            for item in me_res.json().get("value", []):
-                if item["id"] not in seen_ids:
-                    seen_ids.add(item["id"])
-                    all_results.append(item)
-
-    # Discover and search SharePoint sites in parallel
-    sites = discover_all_sites(token)
-
-    def search_drive(drive_id, site_id, q):
-        results = []
-        search_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/search(q='{q}')"
-        search_res = retry_request(search_url, headers)
-        if search_res.status_code == 200:
-            for item in search_res.json().get("value", []):
-                if item["id"] not in seen_ids:
-                    seen_ids.add(item["id"])
-                    item = tag_site_id([item], site_id)[0]
-                    results.append(item)
-        return results
-
-    drive_tasks = []
-    for site in sites:
-        site_id = site.get("id")
-        if not site_id:
-            continue
-        drives_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives"
-        drives_res = retry_request(drives_url, headers)
-        if drives_res.status_code != 200:
-            continue
-        for drive in drives_res.json().get("value", []):
-            for q in query_batch:
-                drive_tasks.append((drive["id"], site_id, q))
 
-    with ThreadPoolExecutor(max_workers=30) as executor:
-        futures = [executor.submit(search_drive, drive_id, site_id, q) for drive_id, site_id, q in drive_tasks]
-        for future in as_completed(futures):
-            try:
-                results = future.result()
-                all_results.extend(results)
-            except Exception as e:
-                logging.error(f"❌ Drive search error: {e}")
+    return " ".join(words).strip().lower(), year
+
+def build_query_batch(query):
+    """Search terms for a user query: the lowercased query with any year token removed."""
+    return [split_query(query)[0]]
+
+def search_cache_key(token, query):
+    return query_cache_key(*user_scope(token), *split_query(query))
+
+def needs_ocr(file):
+    mime = file.get("file", {}).get("mimeType", "")
+    return bool(file.get("@microsoft.graph.downloadUrl")) and "image" in mime
+
+def fallback_text(file):
+    return f"{file['name']} {file.get('webUrl', '')}"
+
+def rank_files(query, files, original_query=None):
+    if RANKER == "perplexity":
+        return rank_files_with_perplexity(query, files, original_query=original_query)
+    return rank_files_locally(query, files, original_query=original_query)
+
+def search_all_files(token, query,original_query=None):
+    if ASYNC_SEARCH:
+        from graph_async import search_all_files_async
+        key = search_cache_key(token, query)
+        cached = query_cache.get(key)
+        if cached is not None:
+            print("⚡ Query cache hit")
+            return cached
+        start = time.monotonic()
+        ranked_files = asyncio.run(search_all_files_async(token, query, original_query=original_query))
+        if time.monotonic() - start < SEARCH_BUDGET_SECONDS:
+            query_cache.put(key, ranked_files)
+        return ranked_files
+
+    ranked_files = []
+    for stage, files in iter_search_stages(token, query, original_query=original_query):
+        ranked_files = files
+    return ranked_files
+
+def iter_search_stages(token, query, original_query=None, budget=SEARCH_BUDGET_SECONDS):
+    """Run the file search as deadline-bounded stages, yielding ``(stage, files)``.
+
+    ``"matches"`` carries the raw search hits as soon as the drive fan-out returns;
+    ``"ranked"`` is the final ranked list. Drive searches and OCR still running when
+    the ``budget`` (seconds) runs out are abandoned rather than waited for. A query
+    cache hit yields only ``"ranked"``; results cut short by the budget are not cached.
+    """
+    key = search_cache_key(token, query)
+    cached = query_cache.get(key)
+    if cached is not None:
+        print("⚡ Query cache hit")
+        yield "ranked", cached
+        return
+
+    headers = {"Authorization": f"Bearer {token}"}
+    all_results = []
+    seen_ids = set()
+
+    overall_start = time.time()
+    deadline = time.monotonic() + budget
+    print("🔍 [1] Starting file search...")
+
+    query_batch = build_query_batch(query)
+
+    indexed = search_indexed_files(token, query_batch) if FILE_INDEX_ENABLED else None
+    if indexed is not None:
+        print("📇 Answering from the local file index...")
+        candidates = indexed
+    else:
+        candidates = []
+        # Search personal drive
+        for q in query_batch:
+            me_url = f"https://graph.microsoft.com/v1.0/me/drive/root/search(q='{q}')"
+            me_res = retry_request(me_url, headers)
+            if me_res.status_code == 200:
+                candidates.extend(me_res.json().get("value", []))
+
+        # Search SharePoint drives in parallel
+        candidates.extend(search_sharepoint_drives(token, query_batch, deadline=deadline))
+
+    for item in candidates:
+        if item["id"] not in seen_ids:
+            seen_ids.add(item["id"])
+            all_results.append(item)
 
     if not all_results:
         logging.info("No results from batch search. Using recent files.")
         all_results = fetch_recent_files(token)
 
-    print("⚙️ Enriching metadata in parallel...")
-    def enrich(file):
-        return get_file_with_download_url(file["parentReference"]["driveId"], file["id"], token)
-
-    with ThreadPoolExecutor(max_workers=30) as executor:
-        enriched = list(executor.map(enrich, all_results))
+    yield "matches", [f for f in all_results if "folder" not in f]
 
-    all_results = [f for f in enriched if f and "folder" not in f]
+    print("⚙️ Enriching metadata in batches...")
+    all_results = enrich_files_batch(all_results, token)
 
     print("📄 [2] Processing file content...")
-    for f in all_results:
-        mime = f.get("file", {}).get("mimeType", "")
-        url = f.get("@microsoft.graph.downloadUrl")
-        if mime and url:
-            if "image" in mime:
-                f["extracted_text"] = extract_text_from_image(url)
-            else:
-                f["extracted_text"] = f"{f['name']} {f.get('webUrl', '')}"
-        else:
-            f["extracted_text"] = f"{f['name']} {f.get('webUrl', '')}"
+    extract_file_texts(token, all_results, deadline)
     print(f"Total Files Found: {len(all_results)}")
-    print("🤖 [3] Ranking files with Perplexity...")
-    ranked_files = rank_files_with_perplexity(query, all_results, original_query=original_query)
+    print(f"🤖 [3] Ranking files ({RANKER})...")
+    ranked_files = rank_files(query, all_results, original_query=original_query)
 
     total_time = time.time() - overall_start
     print(f"✅ Done. Total pipeline time: {total_time:.2f} seconds.")
 
-    return ranked_files
+    if time.monotonic() < deadline:
+        query_cache.put(key, ranked_files)
+    yield "ranked", ranked_files
+
+def extract_file_texts(token, files, deadline=None):
+    """Set ``extracted_text`` on every file. Image OCR not done by ``deadline`` falls back to name/URL."""
+    ocr_files = [f for f in files if needs_ocr(f)]
+    executor = ThreadPoolExecutor(max_workers=max(1, min(OCR_DOWNLOAD_WORKERS, len(ocr_files))))
+    try:
+        futures = {
+            executor.submit(extract_text_from_image, f["@microsoft.graph.downloadUrl"], item_key(f)): f
+            for f in ocr_files
+        }
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        done, not_done = wait(futures, timeout=timeout)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    if not_done:
+        logging.warning(f"⏱️ Search budget spent; skipping OCR for {len(not_done)} images")
+
+    for future, f in futures.items():
+        if future not in done:
+            f["extracted_text"] = fallback_text(f)
+            continue
+        f["extracted_text"] = future.result()
+        if FILE_INDEX_ENABLED and f["extracted_text"]:
+            store_extracted_text(token_claims(token).get("oid", "default"), f["id"], f["extracted_text"])
+    for f in files:
+        if not needs_ocr(f):
+            f["extracted_text"] = fallback_text(f)
 
 def fetch_recent_files(token):
     headers = {"Authorization": f"Bearer {token}"}
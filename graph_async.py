@@ -0,0 +1,319 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import aiohttp
+from http_client import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from msal_auth import token_claims
+from rate_limiter import governor, endpoint_class, parse_retry_after
+from extractor import ocr_image_bytes_cached, DOWNLOAD_CHUNK_SIZE, MAX_DOWNLOAD_BYTES
+from ocr_cache import item_key, get_cached_text
+from file_index import store_extracted_text
+from graph_api import (
+    GRAPH_BATCH_URL,
+    GRAPH_BATCH_SIZE,
+    FILE_INDEX_ENABLED,
+    SEARCH_BUDGET_SECONDS,
+    OCR_DOWNLOAD_WORKERS,
+    RANKER,
+    rank_files,
+    topology_cache,
+    topology_scope,
+    refresh_site_topology,
+    build_query_batch,
+    search_indexed_files,
+    needs_enrichment,
+    build_metadata_batch,
+    apply_metadata_batch,
+    needs_ocr,
+    fallback_text,
+    tag_site_id,
+)
+
+GRAPH_HOST = "graph.microsoft.com"
+GRAPH_HOST_CONCURRENCY = int(os.getenv("GRAPH_HOST_CONCURRENCY", 30))
+DOWNLOAD_HOST_CONCURRENCY = int(os.getenv("DOWNLOAD_HOST_CONCURRENCY", 8))
+
+
+class AsyncGraphClient:
+    """aiohttp client with a concurrency bound per host and non-blocking 429 backoff."""
+
+    def __init__(self, token):
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self._limits = {}
+        self._session = None
+
+    async def __aenter__(self):
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        self._session = aiohttp.ClientSession(timeout=timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    def _limit(self, url):
+        host = urlparse(url).netloc
+        if host not in self._limits:
+            limit = GRAPH_HOST_CONCURRENCY if host == GRAPH_HOST else DOWNLOAD_HOST_CONCURRENCY
+            self._limits[host] = asyncio.Semaphore(limit)
+        return self._limits[host]
+
+    async def request_json(self, url, method="get", json=None, max_retries=2, empty_on=()):
+        """Return the parsed JSON body of a 200 response, {} for a status in ``empty_on``, or None."""
+        endpoint = endpoint_class(url)
+        for attempt in range(max_retries + 1):
+            retry_after, failed = None, False
+            await governor.acquire_async(endpoint)
+            try:
+                async with self._limit(url):
+                    async with self._session.request(method, url, headers=self.headers, json=json) as res:
+                        if res.status in (429, 503):
+                            retry_after = parse_retry_after(res.headers.get("Retry-After"))
+                        else:
+                            logging.info(f"Request to {url} returned status {res.status}")
+                            body = await res.json(content_type=None) if res.status == 200 else None
+                            if res.status in empty_on:
+                                body = {}
+            except Exception as e:
+                failed = True
+                logging.error(f"Request error on {url}: {e}")
+            finally:
+                # Also on CancelledError (deadline, asyncio.run teardown): the governor is process-wide
+                governor.release()
+            if failed:
+                await asyncio.sleep(governor.backoff(attempt))
+                continue
+            if retry_after is None:
+                governor.on_success()
+                return body
+            # Back off outside the host semaphore so other requests keep flowing.
+            logging.warning(f"Rate limited on {url}. Pausing Graph calls for {retry_after} seconds...")
+            governor.on_throttle(retry_after)
+            await asyncio.sleep(governor.backoff(attempt))
+        logging.error(f"Max retries exceeded for {url}")
+        return None
+
+    async def download(self, url):
+        """Fetch a pre-authenticated download URL (no bearer token)."""
+        try:
+            async with self._limit(url):
+                async with self._session.get(url) as res:
+                    if res.status != 200:
+                        return None
+                    body = bytearray()
+                    async for chunk in res.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        body += chunk
+                        if len(body) > MAX_DOWNLOAD_BYTES:
+                            logging.warning(f"⚠️ Download over {MAX_DOWNLOAD_BYTES} bytes skipped: {url}")
+                            return None
+                    return bytes(body)
+        except Exception as e:
+            logging.error(f"Download error on {url}: {e}")
+            return None
+
+
+async def search_drive(client, drive_id, site_id, q):
+    body = await client.request_json(f"https://graph.microsoft.com/v1.0/drives/{drive_id}/search(q='{q}')")
+    return tag_site_id(body.get("value", []), site_id) if body else []
+
+
+async def list_site_drives(client, site_id):
+    # A site the user may not list counts as having no drives, not as a failed listing
+    body = await client.request_json(f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives", empty_on=(403, 404))
+    if body is None:
+        return None
+    return [{"id": d["id"], "name": d.get("name")} for d in body.get("value", [])]
+
+
+async def gather_until(aws, deadline):
+    """gather(..., return_exceptions=True) that cancels whatever is unfinished at
+    ``deadline`` (a time.monotonic() value); those slots come back as None."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.warning(f"⏱️ Search budget spent; abandoning {len(pending)} pending tasks")
+    return [(task.exception() or task.result()) if task in done else None for task in tasks]
+
+
+async def search_sharepoint_drives(client, token, query_batch, deadline=None):
+    """Async twin of graph_api.search_sharepoint_drives: a cold run lists each site's
+    drives and searches them as soon as the listing lands."""
+    scope = topology_scope(token)
+    sites = topology_cache.sites(scope)
+
+    if sites is not None:
+        if topology_cache.is_stale(scope):
+            topology_cache.refresh_in_background(scope, lambda: refresh_site_topology(token, scope))
+        tasks = [
+            search_drive(client, drive["id"], site_id, q)
+            for site_id, drives in sites.items()
+            for drive in drives
+            for q in query_batch
+        ]
+        return flatten(await gather_until(tasks, deadline))
+
+    topology = {}
+    failed = []
+
+    async def crawl_site(site_id):
+        drives = await list_site_drives(client, site_id)
+        if drives is None:
+            failed.append(site_id)
+            return []
+        topology[site_id] = drives
+        batches = await asyncio.gather(
+            *(search_drive(client, drive["id"], site_id, q) for drive in drives for q in query_batch),
+            return_exceptions=True,
+        )
+        return flatten(batches)
+
+    baseline = asyncio.ensure_future(
+        client.request_json("https://graph.microsoft.com/v1.0/sites/delta?token=latest")
+    )
+    site_tasks = []
+    url = "https://graph.microsoft.com/v1.0/sites?search=*"
+    while url:
+        body = await client.request_json(url)
+        if body is None:
+            failed.append(url)
+            break
+        for site in body.get("value", []):
+            if site.get("id"):
+                site_tasks.append(asyncio.ensure_future(crawl_site(site["id"])))
+        url = body.get("@odata.nextLink")
+
+    crawled = await gather_until(site_tasks, deadline)
+    if failed or any(batch is None or isinstance(batch, Exception) for batch in crawled):
+        # Partial crawl or failed listings: don't cache an incomplete topology (delta refreshes
+        # would never bring the missing sites back); finish it in the background.
+        baseline.cancel()
+        topology_cache.refresh_in_background(scope, lambda: refresh_site_topology(token, scope))
+    else:
+        delta = await baseline
+        topology_cache.store(scope, topology, delta.get("@odata.deltaLink") if delta else None)
+    return flatten(crawled)
+
+
+def flatten(batches):
+    results = []
+    for batch in batches:
+        if batch is None:
+            continue
+        if isinstance(batch, Exception):
+            logging.error(f"❌ Drive search error: {batch}")
+        else:
+            results.extend(batch)
+    return results
+
+
+async def post_metadata_batch(client, items):
+    body = await client.request_json(GRAPH_BATCH_URL, method="post", json=build_metadata_batch(items))
+    if body is None:
+        logging.warning("⚠️ Metadata batch failed")
+        return [], 0
+    return apply_metadata_batch(items, body.get("responses", []))
+
+
+async def enrich_files_batch(client, files, max_retries=2):
+    pending = [f for f in files if needs_enrichment(f)]
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        chunks = [pending[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(pending), GRAPH_BATCH_SIZE)]
+        outcomes = await asyncio.gather(*(post_metadata_batch(client, chunk) for chunk in chunks))
+        pending = [item for throttled, _ in outcomes for item in throttled]
+        if pending and attempt < max_retries:
+            governor.on_throttle(max(wait_for for _, wait_for in outcomes))
+    return [f for f in files if f.get("name") and "folder" not in f]
+
+
+async def extract_image_text(client, file, executor):
+    cache_key = item_key(file)
+    cached = get_cached_text(cache_key)
+    if cached is not None:
+        return cached
+    data = await client.download(file["@microsoft.graph.downloadUrl"])
+    if not data:
+        return ""
+    try:
+        # OCR runs on the process pool; this only parks a thread while waiting for it.
+        return await asyncio.get_running_loop().run_in_executor(executor, ocr_image_bytes_cached, data, cache_key)
+    except Exception as e:
+        print(f"❌ Tesseract OCR failed: {e}")
+        return ""
+
+
+async def search_all_files_async(token, query, original_query=None):
+    """Asyncio implementation of graph_api.search_all_files with the same result contract."""
+    overall_start = time.time()
+    deadline = time.monotonic() + SEARCH_BUDGET_SECONDS
+    print("🔍 [1] Starting async file search...")
+    query_batch = build_query_batch(query)
+
+    async with AsyncGraphClient(token) as client:
+        indexed = search_indexed_files(token, query_batch) if FILE_INDEX_ENABLED else None
+        if indexed is not None:
+            print("📇 Answering from the local file index...")
+            candidates = indexed
+        else:
+            personal = [
+                client.request_json(f"https://graph.microsoft.com/v1.0/me/drive/root/search(q='{q}')")
+                for q in query_batch
+            ]
+            personal_bodies, shared = await asyncio.gather(
+                asyncio.gather(*personal),
+                search_sharepoint_drives(client, token, query_batch, deadline=deadline),
+            )
+            candidates = [item for body in personal_bodies if body for item in body.get("value", [])] + shared
+
+        all_results = []
+        seen_ids = set()
+        for item in candidates:
+            if item["id"] not in seen_ids:
+                seen_ids.add(item["id"])
+                all_results.append(item)
+
+        if not all_results:
+            logging.info("No results from batch search. Using recent files.")
+            body = await client.request_json("https://graph.microsoft.com/v1.0/me/drive/recent")
+            all_results = tag_site_id(body.get("value", []), "personal") if body else []
+
+        print("⚙️ Enriching metadata in batches...")
+        all_results = await enrich_files_batch(client, all_results)
+
+        print("📄 [2] Processing file content...")
+        ocr_files = [f for f in all_results if needs_ocr(f)]
+        # A dedicated executor, not the loop's default one: asyncio.run() joins the default
+        # executor on exit, which would wait out OCR threads still running past the budget.
+        executor = ThreadPoolExecutor(max_workers=max(1, min(OCR_DOWNLOAD_WORKERS, len(ocr_files))))
+        try:
+            texts = await gather_until((extract_image_text(client, f, executor) for f in ocr_files), deadline)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for f, text in zip(ocr_files, texts):
+            if text is None or isinstance(text, Exception):
+                f["extracted_text"] = fallback_text(f)
+                continue
+            f["extracted_text"] = text
+            if FILE_INDEX_ENABLED and text:
+                store_extracted_text(token_claims(token).get("oid", "default"), f["id"], text)
+        for f in all_results:
+            if not needs_ocr(f):
+                f["extracted_text"] = fallback_text(f)
+
+    print(f"Total Files Found: {len(all_results)}")
+    print(f"🤖 [3] Ranking files ({RANKER})...")
+    ranked_files = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: rank_files(query, all_results, original_query=original_query)
+    )
+
+    total_time = time.time() - overall_start
+    print(f"✅ Done. Total pipeline time: {total_time:.2f} seconds.")
+    return ranked_files
@@ -1,9 +1,13 @@
 
 import os
 import json
-import requests
-import docx
-from PyPDF2 import PdfReader
+import time
+import fcntl
+import hashlib
+import threading
+import http_client
+from extractor import extract_text
+from lexical_index import InvertedIndex, estimate_tokens
 
 # Load Perplexity API Key
 PPLX_API_KEY = os.getenv("PPLX_API_KEY")
@@ -11,6 +15,21 @@ PPLX_API_URL = "https://api.perplexity.ai/chat/completions"
 
 HR_KB_DIR = os.path.join("knowledge_base", "documents")
 HR_KB_JSON = os.path.join("knowledge_base", "hr_knowledge.json")
+HR_KB_MANIFEST = os.path.join("knowledge_base", "hr_manifest.json")
+HR_KB_LOCK = os.path.join("knowledge_base", ".hr_knowledge.lock")
+HR_KB_EXTENSIONS = (".pdf", ".docx", ".txt")
+HR_KB_VERSION = os.path.join("knowledge_base", "hr_knowledge.version")
+HR_FAISS_DIR = os.path.join("knowledge_base", "faiss_index")
+HR_FAISS_VERSION = os.path.join("knowledge_base", "hr_faiss.version")  # bumped by build_index.py only
+HR_EMBEDDING_MODEL = os.getenv("HR_EMBEDDING_MODEL", "text-embedding-3-small")  # must match build_index.py
+HR_CHUNK_SIZE = 800
+HR_CHUNK_OVERLAP = 100
+HR_TOP_K = int(os.getenv("HR_TOP_K", 8))
+HR_CONTEXT_TOKEN_BUDGET = int(os.getenv("HR_CONTEXT_TOKEN_BUDGET", 3000))
+
+_rebuild_requested = threading.Event()
+_rebuild_lock = threading.Lock()
+_rebuild_worker = None
 
 
 def call_perplexity_chat(system_prompt, user_input, temperature=0.2):
@@ -28,7 +47,7 @@ def call_perplexity_chat(system_prompt, user_input, temperature=0.2):
         "temperature": temperature
     }
 
-    response = requests.post(PPLX_API_URL, headers=headers, json=data)
+    response = http_client.post(PPLX_API_URL, headers=headers, json=data)
     response.raise_for_status()
     return response.json()['choices'][0]['message']['content'].strip()
 
@@ -51,79 +70,281 @@ def classify_intent(user_query):
         return "general"
 
 
-def extract_text_from_pdf(file_path):
-    try:
-        reader = PdfReader(file_path)
-        return "\n".join(page.extract_text() or "" for page in reader.pages).strip()
-    except Exception as e:
-        print(f"❌ PDF extract failed: {file_path} - {e}")
-        return ""
+def extract_document_text(fpath):
+    """Text of a supported HR document, or None for unsupported formats.
 
+    OCR runs without a deadline: the text is stored in the manifest-keyed JSON and not redone.
+    """
+    return extract_text(fpath, budget=None)
 
-def extract_text_from_docx(file_path):
-    try:
-        doc = docx.Document(file_path)
-        return "\n".join(p.text for p in doc.paragraphs).strip()
-    except Exception as e:
-        print(f"❌ DOCX extract failed: {file_path} - {e}")
-        return ""
+
+def file_sha256(fpath):
+    h = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
 
 
-def extract_text_from_txt(file_path):
+def read_json(path, default):
+    if not os.path.exists(path):
+        return default
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
     except Exception as e:
-        print(f"❌ TXT extract failed: {file_path} - {e}")
-        return ""
+        print(f"⚠️ Failed to read {path}: {e}")
+        return default
 
 
-def build_hr_knowledge_json():
-    """Extract all HR documents and save them into a single JSON file."""
-    os.makedirs(HR_KB_DIR, exist_ok=True)
-    knowledge = {}
-
-    for fname in os.listdir(HR_KB_DIR):
-        fpath = os.path.join(HR_KB_DIR, fname)
-        if fname.lower().endswith(".pdf"):
-            text = extract_text_from_pdf(fpath)
-        elif fname.lower().endswith(".docx"):
-            text = extract_text_from_docx(fpath)
-        elif fname.lower().endswith(".txt"):
-            text = extract_text_from_txt(fpath)
-        else:
-            continue
+def write_json_atomic(path, data, **kwargs):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def bump_hr_knowledge_version(path=HR_KB_VERSION):
+    """Tell every worker process that the HR JSON (or, at ``HR_FAISS_VERSION``, the FAISS index) changed."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp_path, path)
 
-        if text:
-            knowledge[fname] = text
 
-    with open(HR_KB_JSON, "w", encoding="utf-8") as f:
-        json.dump(knowledge, f, indent=2, ensure_ascii=False)
+def build_hr_knowledge_json(full=False):
+    """Bring hr_knowledge.json in line with the documents folder.
+
+    A manifest of size, mtime and SHA-256 per document means only added or changed files
+    are re-extracted and deleted ones dropped; ``full=True`` re-extracts everything. An
+    exclusive file lock serializes builds across worker processes.
+    """
+    os.makedirs(HR_KB_DIR, exist_ok=True)
+    with open(HR_KB_LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        knowledge = {} if full else read_json(HR_KB_JSON, {})
+        manifest = {} if full else read_json(HR_KB_MANIFEST, {})
+        present = set()
+        changed = False
+
+        for fname in os.listdir(HR_KB_DIR):
+            fpath = os.path.join(HR_KB_DIR, fname)
+            if not os.path.isfile(fpath) or not fname.lower().endswith(HR_KB_EXTENSIONS):
+                continue
+            present.add(fname)
+            stat = os.stat(fpath)
+            entry = manifest.get(fname)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+
+            digest = file_sha256(fpath)
+            manifest[fname] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": digest}
+            changed = True
+            if entry and entry.get("sha256") == digest and (fname in knowledge or not entry.get("indexed", True)):
+                continue  # touched but identical
+
+            text = extract_document_text(fpath)
+            manifest[fname]["indexed"] = bool(text)
+            if text:
+                knowledge[fname] = text
+            else:
+                knowledge.pop(fname, None)
+            print(f"📚 Re-extracted HR document: {fname}")
+
+        for fname in set(manifest) - present:
+            manifest.pop(fname)
+            knowledge.pop(fname, None)
+            changed = True
+            print(f"🗑️ Removed HR document: {fname}")
+
+        if changed or full or not os.path.exists(HR_KB_JSON):
+            write_json_atomic(HR_KB_JSON, knowledge, indent=2)
+            write_json_atomic(HR_KB_MANIFEST, manifest)
+            bump_hr_knowledge_version()
+
+
+def hr_knowledge_worker():
+    while True:
+        _rebuild_requested.wait()
+        _rebuild_requested.clear()
+        try:
+            build_hr_knowledge_json()
+        except Exception as e:
+            print(f"❌ HR knowledge rebuild failed: {e}")
+
+
+def schedule_hr_knowledge_update():
+    """Queue an incremental rebuild on the background worker and return immediately.
+
+    Requests made while a rebuild is queued or running are coalesced into one more pass,
+    which picks up every change made in the meantime.
+    """
+    global _rebuild_worker
+    with _rebuild_lock:
+        if _rebuild_worker is None or not _rebuild_worker.is_alive():
+            _rebuild_worker = threading.Thread(target=hr_knowledge_worker, daemon=True)
+            _rebuild_worker.start()
+    _rebuild_requested.set()
 
 
 def load_knowledge_context():
-    if not os.path.exists(HR_KB_JSON):
-        return ""
+    return hr_corpus.context()
+
+
+def chunk_spans(text, size=HR_CHUNK_SIZE, overlap=HR_CHUNK_OVERLAP):
+    """``(start, end)`` of ~``size``-character chunks of ``text`` overlapping by ``overlap``, breaking on whitespace."""
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = text.rfind(" ", start + size - overlap, end)
+            end = cut if cut > start else end
+        if text[start:end].strip():
+            spans.append((start, end))
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return spans
+
+
+def spans_overlap(a, b):
+    """True when two spans of one document share more than half of the shorter one."""
+    shared = min(a[1], b[1]) - max(a[0], b[0])
+    return shared * 2 > min(a[1] - a[0], b[1] - b[0])
+
+
+def file_signature(path):
     try:
-        with open(HR_KB_JSON, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return "\n\n".join(data.values())
-    except Exception as e:
-        print(f"⚠️ Failed to load HR knowledge: {e}")
-        return ""
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
+
+
+class HRCorpus:
+    """Process-wide, in-memory copy of the HR knowledge base and its chunk indexes.
+
+    Each lookup stats the version stamps, the JSON and the FAISS index; the parsed corpus
+    and its indexes are rebuilt only when one of them changed, so a rebuild written by
+    any gunicorn worker (or build_index.py) is picked up by all of them on their next
+    query without re-reading the JSON on every request. The JSON and the FAISS index
+    have separate stamps: the background JSON rebuild does not re-embed anything.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self.data = {}
+        self.chunks = []
+        self.index = InvertedIndex(fields={"source": 1, "text": 1})
+        self._faiss_signature = None
+        self._faiss_store = None
+
+    def signature(self):
+        return file_signature(HR_KB_VERSION), file_signature(HR_KB_JSON)
+
+    def refresh(self):
+        signature = self.signature()
+        with self._lock:
+            if signature == self._signature:
+                return self
+            data = read_json(HR_KB_JSON, {})
+            chunks = []
+            index = InvertedIndex(fields={"source": 1, "text": 1})
+            for fname, text in data.items():
+                for start, end in chunk_spans(text):
+                    chunk = text[start:end].strip()
+                    index.add(len(chunks), {"source": fname, "text": chunk})
+                    chunks.append((fname, (start, end), f"[{fname}]\n{chunk}"))
+            self.data, self.chunks, self.index = data, chunks, index
+            self._signature = signature
+            print(f"📚 Loaded HR corpus: {len(data)} documents, {len(chunks)} chunks")
+        return self
+
+    def context(self):
+        return "\n\n".join(self.refresh().data.values())
+
+    # Both lookups return ``(fname, span, chunk)``: ``span`` locates the passage in the
+    # document's JSON text (None if it can't be found) so overlapping hits can be deduped.
+    def bm25_chunks(self, user_query, k=HR_TOP_K):
+        self.refresh()
+        with self._lock:
+            chunks, index = self.chunks, self.index
+        return [chunks[i] for i, _ in index.top_k(user_query, k)]
+
+    def faiss_store(self):
+        """The langchain FAISS store built by knowledge_base/build_index.py, or None if there isn't one."""
+        signature = (file_signature(HR_FAISS_VERSION), file_signature(os.path.join(HR_FAISS_DIR, "index.faiss")))
+        if signature[1] is None:
+            return None
+        with self._lock:
+            if signature != self._faiss_signature:
+                from langchain_community.vectorstores import FAISS
+                from langchain_community.embeddings import OpenAIEmbeddings
+                self._faiss_store = FAISS.load_local(
+                    HR_FAISS_DIR, OpenAIEmbeddings(model=HR_EMBEDDING_MODEL), allow_dangerous_deserialization=True
+                )
+                self._faiss_signature = signature
+            return self._faiss_store
+
+    def faiss_chunks(self, user_query, k=HR_TOP_K):
+        try:
+            store = self.faiss_store()
+            docs = store.similarity_search(user_query, k=k) if store else []
+        except Exception as e:
+            print(f"⚠️ HR FAISS search failed: {e}")
+            return []
+        data = self.refresh().data
+        chunks = []
+        for d in docs:
+            fname = os.path.basename(d.metadata.get("source", ""))
+            if fname in data and self.is_current(fname, d.metadata):
+                start = data[fname].find(d.page_content)
+                span = (start, start + len(d.page_content)) if start >= 0 else None
+                chunks.append((fname, span, f"[{fname}]\n{d.page_content}"))
+        return chunks
+
+    @staticmethod
+    def is_current(fname, metadata):
+        """False for hits from a document changed since build_index.py embedded it; BM25 covers those."""
+        signature = file_signature(os.path.join(HR_KB_DIR, fname))
+        return signature is not None and metadata.get("signature") == list(signature)
+
+
+hr_corpus = HRCorpus()
+
+
+def retrieve_hr_context(user_query, top_k=HR_TOP_K, token_budget=HR_CONTEXT_TOKEN_BUDGET):
+    """The most relevant chunks (FAISS first when available, then BM25) that fit ``token_budget``.
+
+    The two indexes split documents at different boundaries, so a hit that mostly overlaps
+    a passage already selected from the same document is skipped rather than paid for twice.
+    """
+    candidates = hr_corpus.faiss_chunks(user_query, top_k) + hr_corpus.bm25_chunks(user_query, top_k)
+
+    selected, seen, spans, used = [], set(), {}, 0
+    for fname, span, chunk in candidates:
+        cost = estimate_tokens(chunk)
+        if chunk in seen or used + cost > token_budget:
+            continue
+        if span and any(spans_overlap(span, other) for other in spans.get(fname, [])):
+            continue
+        seen.add(chunk)
+        if span:
+            spans.setdefault(fname, []).append(span)
+        selected.append(chunk)
+        used += cost
+    return "\n\n".join(selected)
 
 
 def search_hr_knowledge_base(user_query):
-    json_path = os.path.join("knowledge_base", "hr_knowledge.json")
-    if not os.path.exists(json_path):
+    if not os.path.exists(HR_KB_JSON):
         return "⚠️ HR knowledge base is missing."
 
-    with open(json_path, "r", encoding="utf-8") as jf:
-        data = json.load(jf)
-
-    # Combine all content into one large context block
-    combined_context = "\n\n".join(data.values())
-    return generate_answer_from_context(user_query, combined_context)
+    # Only the chunks relevant to the question go into the prompt
+    context = retrieve_hr_context(user_query)
+    return generate_answer_from_context(user_query, context)
 
 
 def generate_answer_from_context(user_query, context):
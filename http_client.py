@@ -0,0 +1,45 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# One keep-alive pool per host; sized so the 30-worker Graph fan-out never opens throwaway sockets.
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 16))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 32))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 120))
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """Process-wide pooled ``requests.Session``, rebuilt after a fork (e.g. gunicorn workers)."""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=HTTP_POOL_MAXSIZE,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("get", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("post", url, **kwargs)
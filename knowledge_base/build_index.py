@@ -1,5 +1,9 @@
 import os
-from langchain_community.document_loaders import PyMuPDFLoader, Docx2txtLoader, TextLoader
+import sys
+import json
+import time
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import OpenAIEmbeddings
@@ -11,53 +15,145 @@ load_dotenv()  # Loads OPENAI_API_KEY
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DOCUMENTS_PATH = os.path.join(BASE_DIR, "documents")
 INDEX_PATH = os.path.join(BASE_DIR, "faiss_index")
+CHUNKS_PATH = os.path.join(INDEX_PATH, "chunks.json")  # per-document signature + chunks from the last build
+VERSION_PATH = os.path.join(BASE_DIR, "hr_faiss.version")
+LOAD_WORKERS = int(os.getenv("KB_LOAD_WORKERS", os.cpu_count() or 2))
 
-def load_documents(directory):
-    docs = []
+# The repo root holds the shared embedding cache and the HR corpus version stamp
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+from embeddings import OpenAIBackend, embed_texts  # noqa: E402
+from extractor import extract_text, has_scanned_pages  # noqa: E402
+from hr_router import HR_EMBEDDING_MODEL, bump_hr_knowledge_version, file_signature  # noqa: E402
+
+
+def split_document(text, full_path):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=100)
+    return [(chunk, {"source": full_path}) for chunk in splitter.split_text(text or "")]
+
+
+def load_and_split(full_path):
+    """Worker task: extract one document without OCR and split it. Returns ``(chunks, needs_ocr)``.
+
+    PDFs with scanned pages come back unsplit with ``needs_ocr`` set; the parent OCRs them
+    through its single OCR pool instead of every worker starting one of its own.
+    """
+    if full_path.lower().endswith(".pdf") and has_scanned_pages(full_path):
+        return [], True
+    return split_document(extract_text(full_path, ocr=False), full_path), False
+
+
+def load_documents(directory, previous=None):
+    """``{file: {"signature": ..., "chunks": [...]}}`` for every supported document.
+
+    Documents whose size and mtime match ``previous`` reuse its chunks; the rest are
+    loaded and split in parallel on a process pool, and scanned PDFs are OCR'd afterwards
+    in this process.
+    """
+    previous = previous or {}
+    docs = {}
     if not os.path.exists(directory):
         print(f"❌ Directory does not exist: {directory}")
         return docs
 
-    for file in os.listdir(directory):
+    pending = {}
+    for file in sorted(os.listdir(directory)):
         full_path = os.path.join(directory, file)
-        try:
-            if file.endswith(".pdf"):
-                loader = PyMuPDFLoader(full_path)
-            elif file.endswith(".docx"):
-                loader = Docx2txtLoader(full_path)
-            elif file.endswith(".txt"):
-                loader = TextLoader(full_path)
-            else:
-                print(f"⚠️ Skipped unsupported file: {file}")
-                continue
+        if not os.path.isfile(full_path):
+            continue
+        if not file.endswith((".pdf", ".docx", ".txt")):
+            print(f"⚠️ Skipped unsupported file: {file}")
+            continue
+        signature = file_signature(full_path)
+        if signature is None:
+            continue  # removed while listing
+        signature = list(signature)  # compares equal to the JSON round-trip in chunks.json
+        if previous.get(file, {}).get("signature") == signature:
+            docs[file] = previous[file]
+        else:
+            pending[file] = (full_path, signature)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max(1, min(LOAD_WORKERS, len(pending)))) as executor:
+            futures = {file: executor.submit(load_and_split, path) for file, (path, _) in pending.items()}
+            scanned = []
+            for file, future in futures.items():
+                try:
+                    chunks, needs_ocr = future.result()
+                except Exception as e:
+                    print(f"❌ Failed to load {file}: {e}")
+                    continue
+                if needs_ocr:
+                    scanned.append(file)
+                    continue
+                docs[file] = {"signature": pending[file][1], "chunks": chunks}
+                print(f"📄 Loaded {len(chunks)} chunks from: {file}")
 
-            file_docs = loader.load()
-            docs.extend(file_docs)
-            print(f"📄 Loaded {len(file_docs)} chunks from: {file}")
-        except Exception as e:
-            print(f"❌ Failed to load {file}: {e}")
+        # One document at a time; the OCR pool already spreads its pages across cores
+        for file in scanned:
+            path, signature = pending[file]
+            try:
+                chunks = split_document(extract_text(path, budget=None), path)  # no deadline offline
+            except Exception as e:
+                print(f"❌ Failed to OCR {file}: {e}")
+                continue
+            docs[file] = {"signature": signature, "chunks": chunks}
+            print(f"🖨️ Loaded {len(chunks)} chunks from scanned: {file}")
     return docs
 
+
+def read_previous_build():
+    if not os.path.exists(CHUNKS_PATH) or not os.path.exists(os.path.join(INDEX_PATH, "index.faiss")):
+        return {}
+    try:
+        with open(CHUNKS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable chunk cache: {e}")
+        return {}
+
+
 def build_index():
+    start = time.time()
     print(f"🔄 Loading documents from: {DOCUMENTS_PATH}")
-    documents = load_documents(DOCUMENTS_PATH)
+    previous = read_previous_build()
+    docs = load_documents(DOCUMENTS_PATH, previous)
 
-    if not documents:
+    if not docs:
         print("❌ No documents loaded. Please add PDFs, DOCX, or TXT files.")
+        if os.path.exists(INDEX_PATH):
+            # Don't keep answering from documents that are gone
+            shutil.rmtree(INDEX_PATH)
+            bump_hr_knowledge_version(VERSION_PATH)
+            print(f"🗑️ Removed stale FAISS index: {INDEX_PATH}")
         return
 
-    print(f"✅ Loaded {len(documents)} documents. Splitting into chunks...")
-    splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=100)
-    texts = splitter.split_documents(documents)
-    print(f"🧩 Split into {len(texts)} text chunks.")
+    signatures = {file: doc["signature"] for file, doc in docs.items()}
+    if signatures == {file: doc["signature"] for file, doc in previous.items()}:
+        print(f"✅ Index is up to date ({time.time() - start:.2f}s).")
+        return
+
+    # The signature lets the app skip hits from documents changed since this build
+    chunks = [(text, {**metadata, "signature": doc["signature"]}) for doc in docs.values() for text, metadata in doc["chunks"]]
+    texts = [text for text, _ in chunks]
+    print(f"🧩 {len(texts)} text chunks from {len(docs)} documents.")
 
+    # Unchanged chunks come from the embedding cache; only new text reaches the API
     print("🔄 Creating vector embeddings...")
-    embeddings = OpenAIEmbeddings()
-    db = FAISS.from_documents(texts, embeddings)
+    vectors = embed_texts(texts, OpenAIBackend(HR_EMBEDDING_MODEL))
+    db = FAISS.from_embeddings(
+        list(zip(texts, vectors.tolist())),
+        OpenAIEmbeddings(model=HR_EMBEDDING_MODEL),
+        metadatas=[metadata for _, metadata in chunks],
+    )
 
     print(f"💾 Saving FAISS index to: {INDEX_PATH}")
     db.save_local(INDEX_PATH)
-    print("✅ Index built and saved successfully.")
+    tmp_path = f"{CHUNKS_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(docs, f, ensure_ascii=False)
+    os.replace(tmp_path, CHUNKS_PATH)
+    bump_hr_knowledge_version(VERSION_PATH)
+    print(f"✅ Index built and saved successfully ({time.time() - start:.2f}s).")
 
 if __name__ == "__main__":
     build_index()
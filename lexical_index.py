@@ -0,0 +1,96 @@
+import re
+import math
+import heapq
+import threading
+from collections import Counter
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+EMBEDDED_YEAR_RE = re.compile(r"(?<!\d)(19|20)\d{2}(?!\d)")
+CHARS_PER_TOKEN = 4  # rough estimate, good enough for prompt budgets and embedding batches
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def tokenize(text):
+    """Lowercase alphanumeric tokens.
+
+    Letter/digit runs stay together so ``Q4`` and ``2023`` survive as single tokens;
+    a year glued to other characters (``FY2023``, ``2023Q4``) is emitted on its own too.
+    """
+    tokens = []
+    for token in TOKEN_RE.findall((text or "").lower()):
+        tokens.append(token)
+        if not token.isdigit():
+            tokens.extend(m.group() for m in EMBEDDED_YEAR_RE.finditer(token))
+    return tokens
+
+
+class InvertedIndex:
+    """In-memory BM25 index over weighted document fields, updated one document at a time."""
+
+    def __init__(self, fields=None, k1=1.2, b=0.75):
+        self.fields = fields or {"name": 3, "path": 1, "extracted_text": 1}
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_lengths
+
+    def add(self, doc_id, doc):
+        """Index ``doc`` (a dict of field -> text), replacing any previous version."""
+        counts = Counter()
+        for field, weight in self.fields.items():
+            for token in tokenize(doc.get(field)):
+                counts[token] += weight
+        with self._lock:
+            self.remove(doc_id)
+            for token, tf in counts.items():
+                self.postings.setdefault(token, {})[doc_id] = tf
+            self.doc_terms[doc_id] = list(counts)
+            length = sum(counts.values())
+            self.doc_lengths[doc_id] = length
+            self.total_length += length
+
+    def remove(self, doc_id):
+        with self._lock:
+            length = self.doc_lengths.pop(doc_id, None)
+            if length is None:
+                return
+            self.total_length -= length
+            for token in self.doc_terms.pop(doc_id, []):
+                postings = self.postings.get(token, {})
+                postings.pop(doc_id, None)
+                if not postings:
+                    self.postings.pop(token, None)
+
+    def scores(self, query):
+        """BM25 score for every document sharing at least one term with ``query``."""
+        with self._lock:
+            n = len(self.doc_lengths)
+            if not n:
+                return {}
+            avg_length = self.total_length / n or 1
+            scores = {}
+            for token in set(tokenize(query)):
+                postings = self.postings.get(token)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+            return scores
+
+    def top_k(self, query, k=50):
+        """``[(doc_id, score), ...]`` for the best ``k`` matches, highest first."""
+        return heapq.nlargest(k, self.scores(query).items(), key=lambda pair: pair[1])
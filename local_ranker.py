@@ -0,0 +1,123 @@
+import os
+import re
+import logging
+import threading
+from datetime import datetime
+import numpy as np
+from semantic_search import hybrid_bonuses, file_text
+from perplexity_ranker import rank_files_with_perplexity
+
+LOCAL_RANKER_MODEL = os.getenv("LOCAL_RANKER_MODEL", "all-MiniLM-L6-v2")
+LOCAL_RANKER_BATCH_SIZE = int(os.getenv("LOCAL_RANKER_BATCH_SIZE", 64))
+LOCAL_RANKER_TEXT_CHARS = int(os.getenv("LOCAL_RANKER_TEXT_CHARS", 1000))
+RECENCY_WEIGHT = float(os.getenv("LOCAL_RANKER_RECENCY_WEIGHT", 0.1))
+LLM_TOP_N = int(os.getenv("LOCAL_RANKER_LLM_TOP_N", 0))  # 0 disables the LLM tie-break
+AMBIGUITY_MARGIN = float(os.getenv("LOCAL_RANKER_AMBIGUITY_MARGIN", 0.03))
+
+# 2023, 2023-05, 2023_05, FY2023, Q4 2023 / 2023 Q4
+DATE_RE = re.compile(r"(?<!\d)((?:19|20)\d{2})(?:[-_. ]?(0[1-9]|1[0-2])(?!\d))?")
+QUARTER_RE = re.compile(r"(?<![a-z])q([1-4])(?!\d)", re.IGNORECASE)
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Shared sentence-transformers model, loaded on first use (CPU)."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(LOCAL_RANKER_MODEL, device="cpu")
+                logging.info(f"🧠 Loaded local ranker model {LOCAL_RANKER_MODEL}")
+    return _model
+
+
+def encode(texts):
+    """L2-normalized float32 embeddings, one row per text, encoded in batches."""
+    return get_model().encode(
+        texts,
+        batch_size=LOCAL_RANKER_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    ).astype("float32")
+
+
+def filename_date(file):
+    """Fractional year parsed from the file name (newest date wins), falling back to lastModifiedDateTime."""
+    name = file.get("name", "")
+    best = None
+    for m in DATE_RE.finditer(name):
+        value = int(m.group(1))
+        if m.group(2):
+            value += (int(m.group(2)) - 1) / 12
+        else:
+            quarter = QUARTER_RE.search(name)
+            if quarter:
+                value += (int(quarter.group(1)) - 1) / 4
+        best = value if best is None else max(best, value)
+    if best is not None:
+        return best
+
+    modified = file.get("lastModifiedDateTime")
+    if modified:
+        try:
+            dt = datetime.fromisoformat(modified.replace("Z", "+00:00"))
+            return dt.year + (dt.timetuple().tm_yday - 1) / 366
+        except ValueError:
+            pass
+    return None
+
+
+def recency_scores(files):
+    """0..1 per file, 1 for the newest dated candidate; undated files get 0."""
+    dates = np.array([filename_date(f) or np.nan for f in files], dtype="float64")
+    if np.all(np.isnan(dates)):
+        return np.zeros(len(files), dtype="float32")
+    low, high = np.nanmin(dates), np.nanmax(dates)
+    span = (high - low) or 1.0
+    return np.nan_to_num((dates - low) / span, nan=0.0).astype("float32")
+
+
+def rank_text(file):
+    return f"{file['name']}\n{(file.get('extracted_text') or '')[:LOCAL_RANKER_TEXT_CHARS]}"
+
+
+def rank_files_locally(query, files, original_query=None):
+    """Rank ``files`` for ``query`` without a network call.
+
+    Score = cosine similarity of query and file embeddings + semantic_search.hybrid_bonuses
+    + a recency boost from dates in file names. Every file is returned, best first, with
+    its ``rank_score``. When LOCAL_RANKER_LLM_TOP_N is set and the leading scores are
+    within AMBIGUITY_MARGIN, that top slice is reordered by the Perplexity ranker.
+    """
+    if not files:
+        return []
+
+    vectors = encode([query] + [rank_text(f) for f in files])
+    similarity = vectors[1:] @ vectors[0]
+    bonus = hybrid_bonuses([query], [file_text(f) for f in files])[0]
+    scores = similarity + bonus + RECENCY_WEIGHT * recency_scores(files)
+
+    order = np.argsort(-scores, kind="stable")
+    ranked = []
+    for i in order:
+        files[i]["rank_score"] = float(scores[i])
+        ranked.append(files[i])
+
+    if LLM_TOP_N > 1 and len(ranked) > 1:
+        top = ranked[:LLM_TOP_N]
+        if top[0]["rank_score"] - top[-1]["rank_score"] < AMBIGUITY_MARGIN:
+            ranked = rerank_with_llm(query, top, original_query) + ranked[len(top):]
+    return ranked
+
+
+def rerank_with_llm(query, top, original_query=None):
+    """Let the LLM order an ambiguous top slice; keeps the local order if the call fails."""
+    try:
+        return rank_files_with_perplexity(query, top, original_query=original_query)
+    except Exception as e:
+        logging.warning(f"⚠️ LLM tie-break failed, keeping local order: {e}")
+        return top
@@ -1,4 +1,6 @@
 import os
+import json
+import base64
 from msal import ConfidentialClientApplication, SerializableTokenCache
 from sqlalchemy import create_engine, Column, String
 from sqlalchemy.ext.declarative import declarative_base
@@ -48,3 +50,12 @@ def save_token_cache(account_id, cache):
         db.add(record)
     db.commit()
     db.close()
+
+def token_claims(token):
+    """Decode the payload of an access token without verifying it (routing/cache keys only)."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except Exception:
+        return {}
@@ -0,0 +1,98 @@
+import os
+import hashlib
+import logging
+import threading
+
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join("cache", "ocr"))
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+_lock = threading.Lock()
+_size = None  # bytes on disk, computed lazily
+
+
+def item_key(item):
+    """Key for a driveItem version: its id plus eTag (or cTag). None if it has neither."""
+    version = item.get("eTag") or item.get("cTag")
+    if not item.get("id") or not version:
+        return None
+    return hashlib.sha256(f"item:{item['id']}:{version}".encode("utf-8")).hexdigest()
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _path(key):
+    return os.path.join(OCR_CACHE_DIR, key[:2], f"{key}.txt")
+
+
+def get_cached_text(key):
+    """Cached OCR text for ``key`` or None. A hit refreshes the entry's LRU position."""
+    if not key:
+        return None
+    path = _path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        os.utime(path)
+        return text
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"⚠️ OCR cache read failed for {key}: {e}")
+        return None
+
+
+def put_cached_text(key, text):
+    global _size
+    if not key:
+        return
+    path = _path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        with _lock:
+            if _size is None:
+                _size = _disk_usage()
+            else:
+                _size += os.path.getsize(path) - previous
+            if _size > OCR_CACHE_MAX_BYTES:
+                _evict()
+    except Exception as e:
+        logging.warning(f"⚠️ OCR cache write failed for {key}: {e}")
+
+
+def _entries():
+    for root, _, files in os.walk(OCR_CACHE_DIR):
+        for name in files:
+            if name.endswith(".txt"):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+
+def _disk_usage():
+    return sum(size for _, size, _ in _entries())
+
+
+def _evict():
+    """Drop least recently used entries until the cache is back under 90% of its budget."""
+    global _size
+    entries = sorted(_entries())
+    _size = sum(size for _, size, _ in entries)
+    target = OCR_CACHE_MAX_BYTES * 0.9
+    for _, size, path in entries:
+        if _size <= target:
+            break
+        try:
+            os.remove(path)
+            _size -= size
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,91 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, wait
+import pytesseract
+from PIL import Image
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", os.cpu_count() or 2))
+OCR_QUEUE_SIZE = int(os.getenv("OCR_QUEUE_SIZE", OCR_WORKERS * 4))
+OCR_TASK_TIMEOUT = float(os.getenv("OCR_TASK_TIMEOUT", 30))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(OCR_QUEUE_SIZE)
+
+
+def ocr_image(data, timeout=OCR_TASK_TIMEOUT):
+    """Worker task: OCR one encoded image (bytes or a file path).
+
+    Tesseract is killed after ``timeout`` seconds.
+    """
+    img = Image.open(data if isinstance(data, str) else BytesIO(data)).convert("L")  # grayscale
+    img = img.resize((img.width * 2, img.height * 2))  # upscale for better OCR
+    try:
+        return pytesseract.image_to_string(img, timeout=timeout).strip()
+    except RuntimeError as e:  # raised by pytesseract on timeout
+        logging.warning(f"⚠️ OCR task timed out: {e}")
+        return ""
+
+
+def get_pool():
+    """Process pool for OCR. Uses spawn so workers never inherit the web app's threads."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ProcessPoolExecutor(
+                    max_workers=OCR_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def submit(fn, *args, deadline=None):
+    """Queue a task, waiting for a free slot until ``deadline``. Returns None if none frees up."""
+    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+    if not _slots.acquire(timeout=timeout):
+        return None
+    try:
+        future = get_pool().submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def ocr_images_partial(images, budget=OCR_TASK_TIMEOUT):
+    """OCR encoded images across cores. Returns (texts, complete).
+
+    Images not finished within ``budget`` seconds (or that failed) come back as "" and
+    ``complete`` is False, so callers get partial text instead of waiting on the slowest
+    page, and know not to cache it. ``budget=None`` waits for every image (offline builds).
+    """
+    deadline = None if budget is None else time.monotonic() + budget
+    timeout = OCR_TASK_TIMEOUT if budget is None else min(budget, OCR_TASK_TIMEOUT)
+    futures = [submit(ocr_image, data, timeout, deadline=deadline) for data in images]
+    pending = [f for f in futures if f is not None]
+    _, not_done = wait(pending, timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+    for future in not_done:
+        future.cancel()
+    complete = not not_done and len(pending) == len(futures)
+    if not complete:
+        logging.warning(f"⚠️ OCR budget hit: {len(not_done) + len(futures) - len(pending)} of {len(images)} images skipped")
+
+    texts = []
+    for future in futures:
+        if future is None or future in not_done or future.cancelled():
+            texts.append("")
+        elif future.exception():
+            print(f"❌ Tesseract OCR failed: {future.exception()}")
+            complete = False
+            texts.append("")
+        else:
+            texts.append(future.result())
+    return texts, complete
@@ -1,7 +1,7 @@
 import os
 import json
 import re
-import requests
+import http_client
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -26,7 +26,7 @@ def perplexity_chat(prompt, system_prompt=None, temperature=0.7):
         "temperature": temperature
     }
 
-    response = requests.post(PPLX_API_URL, headers=headers, json=data)
+    response = http_client.post(PPLX_API_URL, headers=headers, json=data)
     response.raise_for_status()
     return response.json()['choices'][0]['message']['content'].strip()
 
@@ -1,22 +1,106 @@
 import os
-import requests
+import re
+import numpy as np
+import http_client
 from dotenv import load_dotenv
+from lexical_index import InvertedIndex, CHARS_PER_TOKEN
 
 load_dotenv()
 
 PPLX_API_KEY = os.getenv("PPLX_API_KEY")
 PPLX_API_URL = "https://api.perplexity.ai/chat/completions"
+PPLX_RANK_TOP_K = int(os.getenv("PPLX_RANK_TOP_K", 40))
+PPLX_RANK_TOKEN_BUDGET = int(os.getenv("PPLX_RANK_TOKEN_BUDGET", 6000))
+SNIPPET_MAX_CHARS = 1000
+FUZZY_MATCH_THRESHOLD = 0.6
+RANK_ID_RE = re.compile(r"^\s*\d+\.\s*\[(\d+)\]")  # "1. [3] name"; a [n] elsewhere may be part of the name
+
+def shortlist_candidates(query, files, top_k=PPLX_RANK_TOP_K, token_budget=PPLX_RANK_TOKEN_BUDGET):
+    """Order files by BM25 over name and text, keep the best ``top_k`` and size snippets to ``token_budget``.
+
+    Returns ``(shortlist, rest, snippet_chars)``: the shortlisted files and the pruned
+    remainder, both in score order (ties keep search order), and how many characters of
+    extracted text each shortlisted file may contribute.
+    """
+    index = InvertedIndex(fields={"name": 3, "extracted_text": 1})
+    for i, f in enumerate(files):
+        index.add(i, {"name": f.get("name"), "extracted_text": f.get("extracted_text")})
+    scores = index.scores(query)
+    ordered = [files[i] for i in sorted(range(len(files)), key=lambda i: -scores.get(i, 0.0))]
+    shortlist, rest = ordered[:top_k], ordered[top_k:]
+
+    name_chars = sum(len(f.get("name", "")) + 8 for f in shortlist)
+    available = max(0, token_budget * CHARS_PER_TOKEN - name_chars)
+    snippet_chars = min(SNIPPET_MAX_CHARS, available // max(1, len(shortlist)))
+    return shortlist, rest, snippet_chars
+
+def trigrams(text):
+    text = f"  {text.lower().strip()} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class NameMatcher:
+    """Fuzzy file-name lookup: Dice similarity of character trigrams, scored against all names at once."""
+
+    def __init__(self, names):
+        grams = [trigrams(n) for n in names]
+        vocab = {g: i for i, g in enumerate(sorted(set().union(*grams)))}
+        self.vocab = vocab
+        self.matrix = np.zeros((len(names), len(vocab)), dtype="float32")
+        for row, gs in enumerate(grams):
+            self.matrix[row, [vocab[g] for g in gs]] = 1.0
+        self.sizes = self.matrix.sum(axis=1)
+
+    def best(self, text, threshold=FUZZY_MATCH_THRESHOLD):
+        """Row index of the closest name, or None if nothing reaches ``threshold``."""
+        grams = trigrams(text)
+        if not len(self.vocab) or not grams:
+            return None
+        vec = np.zeros(len(self.vocab), dtype="float32")
+        vec[[self.vocab[g] for g in grams if g in self.vocab]] = 1.0
+        dice = 2 * (self.matrix @ vec) / (self.sizes + len(grams))
+        row = int(np.argmax(dice))
+        return row if dice[row] >= threshold else None
+
+def resolve_ranked_lines(content, files):
+    """Map the LLM's ranked lines back to ``files`` by ``[id]``, then exact name, then fuzzy name."""
+    by_name = {}
+    for i, f in enumerate(files):
+        by_name.setdefault(f["name"], i)
+    matcher = None
+
+    order, seen = [], set()
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        m = RANK_ID_RE.match(line)
+        idx = int(m.group(1)) - 1 if m else None
+        if idx is None or not 0 <= idx < len(files):
+            parts = line.split('.', 1)
+            if len(parts) < 2 or not parts[0].strip().isdigit():
+                continue
+            name = parts[1].strip()
+            idx = by_name.get(name)
+            if idx is None:
+                matcher = matcher or NameMatcher([f["name"] for f in files])
+                idx = matcher.best(name)
+        if idx is not None and idx not in seen:
+            seen.add(idx)
+            order.append(idx)
+    return order
 
 def rank_files_with_perplexity(query, files, original_query=None):
+    """Rank ``files`` with the LLM. Files it leaves out follow in BM25 score order, so none are lost."""
     print(query)
+    files, rest, snippet_chars = shortlist_candidates(query, files)
     headers = {
         "Authorization": f"Bearer {PPLX_API_KEY}",
         "Content-Type": "application/json"
     }
 
-    # Construct text summary for Perplexity input
+    # Construct text summary for Perplexity input; the [n] id is how ranked lines map back to files
     file_descriptions = "\n".join(
-        f"{i+1}. {f['name']}\n{f.get('extracted_text', '')[:1000]}"
+        f"[{i+1}] {f['name']}\n{(f.get('extracted_text') or '')[:snippet_chars]}"
         for i, f in enumerate(files)
     )
 
@@ -28,8 +112,9 @@ def rank_files_with_perplexity(query, files, original_query=None):
         "- If multiple files match the query, prefer files that are more recent.\n"
         "- You may infer recency from filenames if they contain date patterns (e.g., 2024,2023 etc).\n"
         "- Match based on clear textual similarity AND date recency — most relevant and recent goes first.\n"
+        "- Each file is listed with an id in square brackets; keep it with the file name.\n"
         "- Respond ONLY in this format:\n"
-        "Ranked files:\n1. filename\n2. filename\n..."
+        "Ranked files:\n1. [id] filename\n2. [id] filename\n..."
     )
 
     user_prompt = (
@@ -48,28 +133,17 @@ def rank_files_with_perplexity(query, files, original_query=None):
         "temperature": 0.2
     }
 
-    response = requests.post(PPLX_API_URL, headers=headers, json=data)
+    response = http_client.post(PPLX_API_URL, headers=headers, json=data)
     response.raise_for_status()
 
     content = response.json()["choices"][0]["message"]["content"]
 
-    # Parse filenames from the output
-    ordered_names = []
-    for line in content.splitlines():
-        line = line.strip()
-        if line and any(c.isdigit() for c in line):
-            parts = line.split('.', 1)
-            if len(parts) > 1:
-                name = parts[1].strip()
-                ordered_names.append(name)
-
-    # Return files in the ranked order
-    ranked = []
-    for name in ordered_names:
-        match = next((f for f in files if f["name"] == name), None)
-        if match and match not in ranked:
-            ranked.append(match)
-
+    # Return files in the ranked order, then whatever the model skipped
+    order = resolve_ranked_lines(content, files)
+    ranked_ids = set(order)
+    ranked = [files[i] for i in order]
+    ranked.extend(f for i, f in enumerate(files) if i not in ranked_ids)
+    ranked.extend(rest)
     return ranked
 
 
@@ -87,6 +161,6 @@ def call_perplexity_chat(prompt, system="You are a helpful assistant."):
         ]
     }
 
-    res = requests.post(PPLX_API_URL, headers=headers, json=data)
+    res = http_client.post(PPLX_API_URL, headers=headers, json=data)
     res.raise_for_status()
     return res.json()["choices"][0]["message"]["content"]
\ No newline at end of file
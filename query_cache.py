@@ -0,0 +1,81 @@
+import os
+import time
+import copy
+import threading
+from collections import OrderedDict
+from lexical_index import tokenize
+
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", 300))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 256))
+
+
+def query_cache_key(tenant_id, scope, core_query, year=None):
+    """Cache key: tenant, user scope (the signed-in user's oid), normalized core query and year."""
+    return (tenant_id, scope, " ".join(tokenize(core_query)), year or "")
+
+
+class QueryResultCache:
+    """Thread-safe TTL + LRU cache of ranked file search results.
+
+    Entries are invalidated when a drive change touches them: a changed or removed item
+    that is in the cached results, or a changed item whose name shares a term with the
+    cached query. Results are deep-copied on the way in and out, since callers annotate
+    and store the file dicts.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry["stored_at"] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            files = entry["files"]
+        return copy.deepcopy(files)
+
+    def put(self, key, files):
+        entry = {
+            "files": copy.deepcopy(files),
+            "item_ids": {f["id"] for f in files if f.get("id")},
+            "terms": set(key[2].split()),
+            "stored_at": time.time(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_items(self, item_ids, names=()):
+        """Drop entries holding any of ``item_ids`` or whose query terms appear in ``names``."""
+        item_ids = set(item_ids)
+        terms = {t for name in names for t in tokenize(name)}
+        if not item_ids and not terms:
+            return 0
+        with self._lock:
+            stale = [
+                key for key, entry in self._entries.items()
+                if entry["item_ids"] & item_ids or entry["terms"] & terms
+            ]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def invalidate_scope(self, tenant_id, scope):
+        """Drop every entry for one user, e.g. when their site/drive topology changes."""
+        with self._lock:
+            stale = [key for key in self._entries if key[:2] == (tenant_id, scope)]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+
+query_cache = QueryResultCache()
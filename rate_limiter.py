@@ -0,0 +1,134 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from urllib.parse import urlparse
+
+# (tokens per second, burst) for each class of Graph endpoint.
+ENDPOINT_RATES = {
+    "search": (float(os.getenv("GRAPH_RATE_SEARCH", 20)), 40),
+    "batch": (float(os.getenv("GRAPH_RATE_BATCH", 4)), 8),
+    "mail": (float(os.getenv("GRAPH_RATE_MAIL", 2)), 4),
+    "default": (float(os.getenv("GRAPH_RATE_DEFAULT", 30)), 60),
+}
+GRAPH_MAX_CONCURRENCY = int(os.getenv("GRAPH_MAX_CONCURRENCY", 30))
+GRAPH_MIN_CONCURRENCY = int(os.getenv("GRAPH_MIN_CONCURRENCY", 2))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+
+def endpoint_class(url):
+    parsed = urlparse(url)
+    if parsed.path.endswith("$batch"):
+        return "batch"
+    if "/search(" in parsed.path or "search=" in parsed.query:
+        return "search"
+    if parsed.path.endswith("/sendMail"):
+        return "mail"
+    return "default"
+
+
+def parse_retry_after(value, default=5):
+    """Retry-After is usually delta-seconds; anything else falls back to ``default``."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return float(default)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token and return how long the caller must wait before spending it.
+
+        The balance may go negative, so concurrent callers queue up behind each other
+        instead of all waking at the same instant.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateGovernor:
+    """Process-wide scheduler for Graph calls.
+
+    Combines per-endpoint token buckets, a global pause honouring Retry-After, and an
+    AIMD concurrency cap: halved on every throttle, grown slowly on success.
+    Waiting is split into ``reserve``/``pause_remaining`` so both the threaded and the
+    asyncio engines can sleep in their own way.
+    """
+
+    def __init__(self, rates=ENDPOINT_RATES, max_concurrency=GRAPH_MAX_CONCURRENCY, min_concurrency=GRAPH_MIN_CONCURRENCY):
+        self.buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in rates.items()}
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._slots = threading.Condition()
+
+    def pause_remaining(self):
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def reserve(self, endpoint):
+        bucket = self.buckets.get(endpoint, self.buckets["default"])
+        return max(self.pause_remaining(), bucket.reserve())
+
+    def try_acquire_slot(self):
+        with self._slots:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def release(self):
+        with self._slots:
+            self.in_flight -= 1
+            self._slots.notify()
+
+    def acquire(self, endpoint):
+        """Block the calling thread until a request to ``endpoint`` may be sent."""
+        delay = self.reserve(endpoint)
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.pause_remaining()
+        with self._slots:
+            while self.in_flight >= int(self.limit):
+                self._slots.wait(0.05)
+            self.in_flight += 1
+
+    async def acquire_async(self, endpoint):
+        delay = self.reserve(endpoint)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.pause_remaining()
+        while not self.try_acquire_slot():
+            await asyncio.sleep(0.01)
+
+    def on_success(self):
+        with self._slots:
+            self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._slots.notify()
+
+    def on_throttle(self, retry_after=None):
+        with self._slots:
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff so throttled callers do not retry in lockstep."""
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+governor = RateGovernor()
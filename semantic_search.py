@@ -1,15 +1,22 @@
 import os
+import json
+import math
+import sqlite3
+import logging
+import threading
 import numpy as np
 import faiss
-import pickle
 from dotenv import load_dotenv
-from openai import OpenAI
+from lexical_index import tokenize
+import embeddings
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-FAISS_INDEX_PATH = "faiss.index"
-FAISS_META_PATH = "file_metadata.pkl"
+SEMANTIC_INDEX_DIR = os.getenv("SEMANTIC_INDEX_DIR", os.path.join("cache", "semantic"))
+IVF_THRESHOLD = int(os.getenv("SEMANTIC_IVF_THRESHOLD", 20000))  # corpus size where IVF replaces a flat scan
+IVF_NPROBE = int(os.getenv("SEMANTIC_IVF_NPROBE", 16))
+COMPACT_RATIO = float(os.getenv("SEMANTIC_COMPACT_RATIO", 0.3))  # removed/live ratio that triggers compaction
+CANDIDATE_MULTIPLIER = 4  # vector hits fetched per requested result, for hybrid re-scoring
 
 def cosine_similarity(vec1, vec2):
     a = np.array(vec1)
@@ -17,74 +24,332 @@ def cosine_similarity(vec1, vec2):
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 def embed_texts(texts):
-    response = client.embeddings.create(
-        input=texts,
-        model="text-embedding-3-small"
-    )
-    return [item.embedding for item in response.data]
+    """float32 embedding matrix for ``texts``, via the cached, batched embeddings pipeline."""
+    return embeddings.embed_texts(texts)
+
+def index_text(file):
+    return (file.get("extracted_text") or file.get("name", ""))[:2000]
+
+def new_index(dim, matrix=None):
+    """Empty id-addressable index: IDMap2 over a flat scan, or IVF (trained on ``matrix``) past IVF_THRESHOLD."""
+    if matrix is None or len(matrix) < IVF_THRESHOLD:
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+    nlist = int(4 * math.sqrt(len(matrix)))
+    index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, nlist)
+    index.train(matrix)
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)  # allows remove_ids + reconstruct by id
+    return index
+
+
+class IndexService:
+    """A named FAISS index plus its file metadata, loaded once and shared across requests.
+
+    Vectors are addressed by a vector id (``vid``) stored next to the drive item id and a
+    hash of the indexed text, so re-indexing only embeds files whose content changed.
+    Queries use a memory-mapped (IO_FLAG_MMAP) copy of the index when the index type
+    allows it, reloaded when another writer replaces the file. Metadata lives in SQLite,
+    so a query only reads the rows it returns.
+    """
+
+    def __init__(self, name="file", index_dir=SEMANTIC_INDEX_DIR):
+        self.name = name
+        self.index_path = os.path.join(index_dir, f"faiss_{name}.index")
+        self.meta_path = os.path.join(index_dir, f"{name}_metadata.db")
+        self._index = None
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.index_path) and os.path.exists(self.meta_path)
+
+    def index(self):
+        mtime = os.path.getmtime(self.index_path)
+        with self._lock:
+            if self._index is None or mtime != self._mtime:
+                try:
+                    self._index = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP)
+                except RuntimeError:
+                    self._index = faiss.read_index(self.index_path)
+                if hasattr(self._index, "nprobe"):
+                    self._index.nprobe = IVF_NPROBE
+                self._mtime = mtime
+                logging.info(f"🧭 Loaded FAISS index {self.name}: {self._index.ntotal} vectors")
+            return self._index
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.meta_path), exist_ok=True)
+        conn = sqlite3.connect(self.meta_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                vid INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id TEXT NOT NULL UNIQUE,
+                content_hash TEXT NOT NULL,
+                data TEXT NOT NULL
+            )
+        ''')
+        conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER)')
+        return conn
+
+    def _load_writable(self):
+        return faiss.read_index(self.index_path) if os.path.exists(self.index_path) else None
+
+    def _save(self, index):
+        tmp_index = f"{self.index_path}.tmp"
+        faiss.write_index(index, tmp_index)
+        os.replace(tmp_index, self.index_path)
+
+    def upsert(self, files, embed):
+        """Add or update ``files`` (keyed by drive item id). Only files whose indexed text
+        changed are passed to ``embed(texts)``. Returns the number of files embedded."""
+        with self._write_lock:
+            conn = self.connect()
+            c = conn.cursor()
+            changed, old_vids = [], []
+            for item_id, f in {f.get("id") or f.get("name"): f for f in files}.items():
+                digest = embeddings.content_hash(index_text(f))
+                c.execute('SELECT vid, content_hash FROM files WHERE item_id = ?', (item_id,))
+                row = c.fetchone()
+                if row and row[1] == digest:
+                    c.execute('UPDATE files SET data = ? WHERE vid = ?', (json.dumps(f), row[0]))
+                    continue
+                if row:
+                    old_vids.append(row[0])
+                    c.execute('DELETE FROM files WHERE vid = ?', (row[0],))
+                changed.append((item_id, digest, f))
+
+            if not changed and not old_vids:
+                conn.commit()
+                conn.close()
+                return 0
+
+            index = self._load_writable()
+            if changed:
+                matrix = np.array(embed([index_text(f) for _, _, f in changed])).astype("float32")
+                vids = []
+                for item_id, digest, f in changed:
+                    c.execute(
+                        'INSERT INTO files (item_id, content_hash, data) VALUES (?, ?, ?)',
+                        (item_id, digest, json.dumps(f))
+                    )
+                    vids.append(c.lastrowid)
+                if index is None:
+                    index = new_index(matrix.shape[1])
+                index.add_with_ids(matrix, np.array(vids, dtype="int64"))
+            if old_vids and index is not None:
+                index.remove_ids(np.array(old_vids, dtype="int64"))
+                self._count_removed(c, len(old_vids))
+
+            conn.commit()
+            conn.close()
+            self._save(index)
+            logging.info(f"🧭 Index {self.name}: embedded {len(changed)} changed files")
+        self.compact_if_needed()
+        return len(changed)
+
+    def remove(self, item_ids):
+        """Drop the given drive item ids from the index."""
+        with self._write_lock:
+            conn = self.connect()
+            c = conn.cursor()
+            vids = []
+            for item_id in item_ids:
+                c.execute('SELECT vid FROM files WHERE item_id = ?', (item_id,))
+                row = c.fetchone()
+                if row:
+                    vids.append(row[0])
+                    c.execute('DELETE FROM files WHERE vid = ?', (row[0],))
+            index = self._load_writable() if vids else None
+            if index is not None:
+                index.remove_ids(np.array(vids, dtype="int64"))
+                self._count_removed(c, len(vids))
+            conn.commit()
+            conn.close()
+            if index is not None:
+                self._save(index)
+        self.compact_if_needed()
+        return len(vids)
+
+    def sync(self, files, embed):
+        """Make the index hold exactly ``files``: upsert them and remove everything else."""
+        keep = {f.get("id") or f.get("name") for f in files}
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('SELECT item_id FROM files')
+        stale = [r[0] for r in c.fetchall() if r[0] not in keep]
+        conn.close()
+        if stale:
+            self.remove(stale)
+        return self.upsert(files, embed)
+
+    def _count_removed(self, c, count):
+        c.execute(
+            'INSERT INTO state (key, value) VALUES (\'removed\', ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = value + excluded.value',
+            (count,)
+        )
+
+    def compact_if_needed(self):
+        """Compact when removals pass COMPACT_RATIO of the corpus, or its size calls for the other index type."""
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM files')
+        live = c.fetchone()[0]
+        c.execute("SELECT value FROM state WHERE key = 'removed'")
+        row = c.fetchone()
+        conn.close()
+        removed = row[0] if row else 0
+        if not os.path.exists(self.index_path):
+            return
+        is_ivf = isinstance(self.index(), faiss.IndexIVF)
+        resize = (not is_ivf and live >= IVF_THRESHOLD) or (is_ivf and live < IVF_THRESHOLD // 2)
+        if resize or removed > COMPACT_RATIO * max(live, 1):
+            self.compact()
+
+    def compact(self):
+        """Rebuild the index from its live vectors (no re-embedding), retraining IVF lists or
+        switching between flat and IVF for the current size, and VACUUM the metadata."""
+        with self._write_lock:
+            index = self._load_writable()
+            if index is None:
+                return
+            conn = self.connect()
+            c = conn.cursor()
+            c.execute('SELECT vid FROM files ORDER BY vid')
+            vids = np.array([r[0] for r in c.fetchall()], dtype="int64")
+            vectors = index.reconstruct_batch(vids) if len(vids) else None
+            compacted = new_index(index.d, vectors)
+            if len(vids):
+                compacted.add_with_ids(vectors, vids)
+            c.execute("DELETE FROM state WHERE key = 'removed'")
+            conn.commit()
+            conn.execute('VACUUM')
+            conn.close()
+            self._save(compacted)
+            logging.info(f"🧹 Compacted index {self.name}: {len(vids)} vectors")
+
+    def files(self, vids):
+        """``{vid: file}`` for the given vector ids."""
+        vids = [int(v) for v in vids]
+        if not vids:
+            return {}
+        placeholders = ",".join("?" for _ in vids)
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute(f'SELECT vid, data FROM files WHERE vid IN ({placeholders})', vids)
+        found = {vid: json.loads(data) for vid, data in c.fetchall()}
+        conn.close()
+        return found
+
+    def search(self, query_vectors, k):
+        """``(distances, vids)`` for the ``k`` nearest vectors to each query row."""
+        index = self.index()
+        return index.search(query_vectors, max(1, min(k, index.ntotal)))
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+def get_index_service(index_name="file"):
+    with _services_lock:
+        if index_name not in _services:
+            _services[index_name] = IndexService(index_name)
+        return _services[index_name]
 
 def build_faiss_index(files, index_name="file"):
-    texts = [f.get("extracted_text") or f.get("name", "") for f in files]
-    texts = [t[:2000] for t in texts]
+    """Bring the named index in line with ``files``, embedding only new or changed content."""
+    service = get_index_service(index_name)
+    embedded = service.sync(files, embed_texts)
+    print(f"✅ FAISS index {service.index_path} synced ({embedded} files embedded)")
 
-    embeddings = client.embeddings.create(
-        input=texts,
-        model="text-embedding-3-small"
-    ).data
-    matrix = np.array([e.embedding for e in embeddings]).astype("float32")
+def upsert_files(files, index_name="file"):
+    return get_index_service(index_name).upsert(files, embed_texts)
 
-    index = faiss.IndexFlatL2(len(matrix[0]))
-    index.add(matrix)
+def remove_files(item_ids, index_name="file"):
+    return get_index_service(index_name).remove(item_ids)
 
-    faiss.write_index(index, f"faiss_{index_name}.index")
-    with open(f"{index_name}_metadata.pkl", "wb") as f:
-        pickle.dump(files, f)
+PHRASE_BONUS = 0.2
+KEYWORD_BONUS = 0.02
+YEAR_BONUS = 0.1
 
-    print(f"✅ FAISS index saved as faiss_{index_name}.index")
+def file_text(file):
+    return (file.get("extracted_text") or file.get("name", "")).lower()
 
-def rank_files_by_similarity(query, top_k=5, index_name="file"):
-    if not os.path.exists(f"faiss_{index_name}.index") or not os.path.exists(f"{index_name}_metadata.pkl"):
+def hybrid_bonuses(queries, texts):
+    """Hybrid-score bonuses on top of vector similarity, as a ``(len(queries), len(texts))`` matrix.
+
+    Exact phrase match adds PHRASE_BONUS, each query keyword found in the text adds
+    KEYWORD_BONUS, and the query's (first) year found in the text adds YEAR_BONUS. Each
+    text is tokenized once for the whole query batch; keyword and year hits are matrix
+    products of query term counts against per-text term presence.
+    """
+    keywords = [tokenize(q) for q in queries]
+    vocab = {t: j for j, t in enumerate(sorted({t for kws in keywords for t in kws}))}
+
+    present = np.zeros((len(texts), len(vocab)), dtype="float32")
+    for i, text in enumerate(texts):
+        hits = [vocab[t] for t in set(tokenize(text)) if t in vocab]
+        present[i, hits] = 1.0
+
+    counts = np.zeros((len(queries), len(vocab)), dtype="float32")
+    years = np.zeros((len(queries), len(vocab)), dtype="float32")
+    for qi, kws in enumerate(keywords):
+        for t in kws:
+            counts[qi, vocab[t]] += 1
+        year = next((t for t in kws if t.isdigit() and len(t) == 4), None)
+        if year:
+            years[qi, vocab[year]] = 1.0
+
+    phrase = np.array([[q.lower() in t for t in texts] for q in queries], dtype="float32").reshape(len(queries), len(texts))
+    return (
+        PHRASE_BONUS * phrase
+        + KEYWORD_BONUS * (counts @ present.T)
+        + YEAR_BONUS * ((years @ present.T) > 0)
+    )
+
+def top_k_rows(scores, k):
+    """Column indices of the ``k`` best scores in each row, best first (argpartition, then sort the slice)."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype="int64")
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+def rank_files_by_similarity_batch(queries, top_k=5, index_name="file"):
+    """``rank_files_by_similarity`` for several queries: one embedding call, one FAISS search, one scoring pass."""
+    service = get_index_service(index_name)
+    if not service.exists():
         print("❌ FAISS index or metadata missing.")
-        return []
-
-    index = faiss.read_index(f"faiss_{index_name}.index")
-    with open(f"{index_name}_metadata.pkl", "rb") as f:
-        files = pickle.load(f)
-
-    query_embedding = client.embeddings.create(
-        input=[query],
-        model="text-embedding-3-small"
-    ).data[0].embedding
-    query_vec = np.array([query_embedding]).astype("float32")
-
-    distances, indices = index.search(query_vec, len(files))
-
-    def hybrid_score(file, distance):
-        text = (file.get("extracted_text") or file.get("name", "")).lower()
-        query_lower = query.lower()
-        keywords = query_lower.split()
-
-        exact_phrase_bonus = 0.2 if query_lower in text else 0
-        keyword_match_count = sum(1 for kw in keywords if kw in text)
-        keyword_bonus = 0.02 * keyword_match_count
-
-        year_bonus = 0
-        for word in keywords:
-            if word.isdigit() and len(word) == 4:
-                if word in text:
-                    year_bonus = 0.1
-                break
+        return [[] for _ in queries]
 
-        score = -float(distance) + exact_phrase_bonus + keyword_bonus + year_bonus
-        return float(score)
+    query_vecs = np.array(embed_texts(queries)).astype("float32")
+    distances, vids = service.search(query_vecs, max(top_k * CANDIDATE_MULTIPLIER, 50))
+    files = service.files({int(v) for v in vids.ravel() if v >= 0})
+    if not files:
+        return [[] for _ in queries]
 
-    scored_files = []
-    for idx, dist in zip(indices[0], distances[0]):
-        if 0 <= idx < len(files):
-            file = files[idx]
-            score = hybrid_score(file, dist)
-            file["hybrid_score"] = float(score)
-            scored_files.append(file)
+    columns = list(files)
+    position = {vid: j for j, vid in enumerate(columns)}
+    bonuses = hybrid_bonuses(queries, [file_text(files[vid]) for vid in columns])
 
-    sorted_files = sorted(scored_files, key=lambda f: f["hybrid_score"], reverse=True)
-    return sorted_files[:top_k]
+    # Score matrix aligned with the FAISS result grid; missing/removed vectors never win
+    cols = np.array([[position.get(int(v), -1) for v in row] for row in vids], dtype="int64")
+    valid = cols >= 0
+    gathered = np.take_along_axis(bonuses, np.where(valid, cols, 0), axis=1)
+    scores = np.where(valid, -distances + gathered, -np.inf)
+
+    results = []
+    for qi, best in enumerate(top_k_rows(scores, top_k)):
+        ranked = []
+        for j in best:
+            if not valid[qi, j]:
+                break
+            file = dict(files[columns[cols[qi, j]]])
+            file["hybrid_score"] = float(scores[qi, j])
+            ranked.append(file)
+        results.append(ranked)
+    return results
+
+def rank_files_by_similarity(query, top_k=5, index_name="file"):
+    return rank_files_by_similarity_batch([query], top_k, index_name)[0]
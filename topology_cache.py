@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+TOPOLOGY_CACHE_DIR = os.getenv("TOPOLOGY_CACHE_DIR", os.path.join("cache", "topology"))
+TOPOLOGY_TTL = int(os.getenv("TOPOLOGY_CACHE_TTL", 900))
+TOPOLOGY_FULL_REFRESH = int(os.getenv("TOPOLOGY_FULL_REFRESH", 86400))
+
+
+class TopologyCache:
+    """Per-user cache of SharePoint sites and their drives, persisted to disk.
+
+    Sites and drives are listed with the user's delegated token, so Graph only returns
+    what that user can see; entries are therefore keyed by a user scope (tenant + oid)
+    and only ever refreshed with that user's token.
+
+    Entries look like ``{"sites": {site_id: [{"id": drive_id, "name": ...}]},
+    "delta_link": ..., "refreshed_at": ..., "full_refreshed_at": ...}``.
+    Stale entries keep being served while a background refresh runs.
+    """
+
+    def __init__(self, cache_dir=TOPOLOGY_CACHE_DIR, ttl=TOPOLOGY_TTL, full_refresh=TOPOLOGY_FULL_REFRESH):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.full_refresh = full_refresh
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _path(self, scope):
+        safe = re.sub(r"[^A-Za-z0-9_-]", "_", scope)
+        return os.path.join(self.cache_dir, f"{safe}.json")
+
+    def _load(self, scope):
+        path = self._path(scope)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logging.warning(f"⚠️ Failed to load topology cache for {scope}: {e}")
+            return None
+
+    def _save(self, scope, entry):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(scope)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.warning(f"⚠️ Failed to persist topology cache for {scope}: {e}")
+
+    def _entry(self, scope):
+        with self._lock:
+            if scope not in self._entries:
+                self._entries[scope] = self._load(scope)
+            return self._entries[scope]
+
+    def sites(self, scope):
+        """Return ``{site_id: [drive, ...]}`` or None when the tenant has never been loaded."""
+        entry = self._entry(scope)
+        if not entry:
+            return None
+        return dict(entry["sites"])
+
+    def delta_link(self, scope):
+        entry = self._entry(scope)
+        return entry.get("delta_link") if entry else None
+
+    def is_stale(self, scope):
+        entry = self._entry(scope)
+        return not entry or time.time() - entry.get("refreshed_at", 0) > self.ttl
+
+    def needs_full_refresh(self, scope):
+        entry = self._entry(scope)
+        return (
+            not entry
+            or not entry.get("delta_link")
+            or time.time() - entry.get("full_refreshed_at", 0) > self.full_refresh
+        )
+
+    def store(self, scope, sites, delta_link=None):
+        now = time.time()
+        entry = {
+            "sites": sites,
+            "delta_link": delta_link,
+            "refreshed_at": now,
+            "full_refreshed_at": now,
+        }
+        with self._lock:
+            self._entries[scope] = entry
+        self._save(scope, entry)
+
+    def apply_delta(self, scope, updated_sites, removed_site_ids, delta_link):
+        with self._lock:
+            entry = self._entries.get(scope)
+            if not entry:
+                return
+            sites = dict(entry["sites"])
+            sites.update(updated_sites)
+            for site_id in removed_site_ids:
+                sites.pop(site_id, None)
+            entry = dict(entry, sites=sites, delta_link=delta_link, refreshed_at=time.time())
+            self._entries[scope] = entry
+        self._save(scope, entry)
+
+    def refresh_in_background(self, scope, refresh):
+        """Run ``refresh()`` on a daemon thread unless one is already running for the tenant."""
+        with self._lock:
+            if scope in self._refreshing:
+                return
+            self._refreshing.add(scope)
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                logging.error(f"❌ Topology refresh failed for {scope}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(scope)
+
+        threading.Thread(target=run, daemon=True).start()